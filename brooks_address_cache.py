@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_address_cache.py
+# Purpose:     on-disk cache of the long addresses found by command #11
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+
+import os
+import json
+import threading
+
+#: Default location of the cache file.
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'),
+                            '.brooks_address_cache.json')
+
+
+class AddressCache(object):
+    """ Long address, manufacturer id and device type of the devices,
+    by (port, tag), kept in a JSON file.
+
+    `Brooks` looks its tag up here before identifying the device with
+    command #11, and stores the result of every identification.
+
+    Args:
+        path: the JSON file, created on the first `put()`.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _key(port, tag):
+        return '%s|%s' % (port, tag)
+
+    def get(self, port, tag):
+        """ Cached identity of `tag` on `port`.
+
+        Returns:
+            `{'long_address': hex str, 'manufacturer_id': int,
+            'device_type': int}` or None.
+        """
+        with self._lock:
+            return self._entries.get(self._key(port, tag))
+
+    def put(self, port, tag, address, manufacturer_id, device_type):
+        """ Store the identity of `tag` on `port` and save the file.
+
+        Args:
+            address: bytes long address.
+        """
+        with self._lock:
+            self._entries[self._key(port, tag)] = {
+                'long_address': address.hex(),
+                'manufacturer_id': manufacturer_id,
+                'device_type': device_type}
+            self._save()
+
+    def discard(self, port, tag):
+        """ Forget `tag` on `port`, i.e. once it turned out to be wrong.
+        """
+        with self._lock:
+            if self._entries.pop(self._key(port, tag), None) is not None:
+                self._save()
+
+    def _save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.replace(temporary, self.path)
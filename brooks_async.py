@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_async.py
+# Purpose:     asyncio driver for MFC SLA58XX series
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" asyncio version of the s-protocol driver.
+
+Replies are received through `loop.add_reader()` on the serial port file
+descriptor, so many buses are polled from a single thread: transactions
+on one port are serialised, transactions on different ports overlap.
+Example::
+
+    async def main():
+        buses = [AsyncTransport.open(port) for port in PORTS]
+        mfcs = [await AsyncBrooks.connect(tag, bus) for tag, bus in ...]
+        flows = await asyncio.gather(*(mfc.read_flow() for mfc in mfcs))
+
+*N.B.* `add_reader()` needs a selector event loop and a real file
+descriptor, i.e. a POSIX serial port.
+"""
+
+import struct
+import asyncio
+
+import serial
+
+from brooks_frame import (pack_ascii, encode_frame, encode_message,
+                          parse_frame, is_reply_to, FrameCache, FrameDecoder,
+                          FrameError, ChecksumError, BROADCAST_ADDRESS)
+from brooks_commands import (READ_PRIMARY_VARIABLE, READ_DYNAMIC_VARIABLES,
+                             READ_UNIQUE_IDENTIFIER_BY_TAG, READ_FLOW_RANGE,
+                             SELECT_FLOW_UNIT, READ_SETPOINT, WRITE_SETPOINT,
+                             READ_TOTALIZER_STATUS, SET_TOTALIZER,
+                             READ_TOTALIZER)
+from brooks_transport import ErrorStatus
+
+
+class AsyncTransport(object):
+    """ Non-blocking access to one RS485 bus.
+
+    The transport owns the serial port; devices sharing the bus share the
+    transport, which serialises their transactions with an `asyncio.Lock`.
+
+    Args:
+        ser: an opened `serial.Serial`, switched to non-blocking reads.
+    """
+    #: Deadline in seconds for receiving a complete response frame.
+    timeout = 0.5
+    #: Number of attempts before giving up a transaction.
+    retries = 9
+
+    def __init__(self, ser):
+        self.ser = ser
+        if self.ser.timeout != 0: # reconfigures the port
+            self.ser.timeout = 0
+        self._lock = None
+
+    @classmethod
+    def open(cls, port):
+        """ Open `port` with the s-protocol settings (19200 baud, 8O1).
+        """
+        return cls(serial.Serial(port, 19200, parity=serial.PARITY_ODD,
+                                 bytesize=serial.EIGHTBITS,
+                                 stopbits=serial.STOPBITS_ONE, timeout=0))
+
+    def close(self):
+        self.ser.close()
+
+    async def transaction(self, frame):
+        """ Write an encoded frame and wait for the response.
+
+        Args:
+            frame: the frame built by `brooks_frame.encode_frame()`.
+
+        Returns:
+            the response `Frame`, its data starting with the 2 status bytes.
+
+        Raises:
+            ErrorStatus: no valid response after `retries` attempts.
+        """
+        request = parse_frame(frame)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            for attempt in range(self.retries):
+                try:
+                    return await self._attempt(frame, request)
+                except FrameError as e:
+                    error = e
+            raise ErrorStatus('no valid response: %s' % error)
+
+    async def _attempt(self, frame, request):
+        """ c.f. `brooks_transport.transaction()`: the input is flushed
+        before the write and replies to an other request are skipped.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        decoder = FrameDecoder()
+        fd = self.ser.fileno()
+
+        def on_readable():
+            if future.done():
+                return
+            try:
+                frames = decoder.feed(self.ser.read(self.ser.in_waiting or 1))
+            except Exception as e:
+                future.set_exception(e)
+                return
+            for reply in frames:
+                if is_reply_to(reply, request):
+                    future.set_result(reply)
+                    return
+            if decoder.checksum_errors:
+                future.set_exception(ChecksumError('wrong checksum'))
+
+        self.ser.reset_input_buffer()
+        loop.add_reader(fd, on_readable)
+        try:
+            self.ser.write(frame)
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise FrameError('timeout, %d bytes pending' % len(decoder.buffer))
+        finally:
+            loop.remove_reader(fd)
+
+
+class AsyncBrooks(object):
+    """ Coroutine based driver for Brooks s-protocol series SLA58XX.
+
+    Same commands as `brooks_s_protocol.Brooks`, as coroutines. Use
+    `AsyncBrooks.connect()` to create an identified device.
+
+    Args:
+        tag: 8-digits tag number
+        transport: `AsyncTransport` of the bus the device is on.
+    """
+    #: Number of request frames with data (i.e. `set_flow`) kept encoded.
+    frame_cache_size = 32
+
+    def __init__(self, tag, transport):
+        self.tag = tag
+        self.transport = transport
+        self.address = None
+        self._frames = FrameCache(self.frame_cache_size)
+
+    @classmethod
+    async def connect(cls, tag, transport):
+        """ Create a device and identify it with command #11.
+        """
+        device = cls(tag, transport)
+        await device.identify()
+        return device
+
+    async def identify(self):
+        """ Read the long address of the device by its tag (command #11).
+        """
+        command = READ_UNIQUE_IDENTIFIER_BY_TAG
+        response = await self.transport.transaction(encode_frame(
+            BROADCAST_ADDRESS, command.number,
+            command.encode(pack_ascii(self.tag[-8:]))))
+        deviceid = command.decode(response.data, 2)
+        self.address = bytes((deviceid.manufacturer_id,
+                              deviceid.device_type)) + deviceid.device_id
+
+    @property
+    def long_address(self):
+        """ Long address as an hex string.
+        """
+        return self.address.hex()
+
+    async def comm(self, command):
+        """ c.f. `Brooks.comm()`.
+        """
+        if isinstance(command, str):
+            command = bytes.fromhex(command)
+        try:
+            response = await self.transport.transaction(
+                encode_message(command))
+        except ErrorStatus:
+            return 'Error'
+        return response.data.hex()
+
+    async def comm2(self, cmd, data=b''):
+        """ c.f. `Brooks.comm2()`.
+        """
+        if isinstance(cmd, str):
+            raw = bytes.fromhex(cmd)
+            cmd, data = raw[0], raw[2:]
+        response = await self.transport.transaction(
+            self._frames.get(self.address, cmd, data))
+        return response.data[:2], response.data[2:]
+
+    async def execute(self, command, *args):
+        """ c.f. `Brooks.execute()`.
+        """
+        status, data = await self.comm2(command.number, command.encode(*args))
+        return command.decode(data)
+
+    async def read_flow(self): #command #1
+        """ c.f. `Brooks.read_flow()`.
+        """
+        try:
+            return (await self.execute(READ_PRIMARY_VARIABLE)).pv
+        except (ErrorStatus, struct.error):
+            return -1
+
+    async def read_dynamic_variables(self): #command #3
+        """ c.f. `Brooks.read_dynamic_variables()`.
+        """
+        status, data = await self.comm2(READ_DYNAMIC_VARIABLES.number)
+        reply = READ_DYNAMIC_VARIABLES.decode_partial(data)
+        if reply.pv is None:
+            raise struct.error('no primary variable in command #3 response')
+        return reply
+
+    async def read_flow_range(self, select_code=1): #command #151
+        """ c.f. `Brooks.read_flow_range()`.
+        """
+        try:
+            reply = await self.execute(READ_FLOW_RANGE, select_code)
+        except (ErrorStatus, struct.error):
+            return -1, 171
+        return reply.flow_range, reply.unit_code
+
+    async def read_setpoint(self): #command #235
+        """ c.f. `Brooks.read_setpoint()`.
+        """
+        reply = await self.execute(READ_SETPOINT)
+        return reply.setpoint, reply.unit_code
+
+    async def set_flow(self, flowrate, unit_code=250): #command #236
+        """ c.f. `Brooks.set_flow()`.
+        """
+        reply = await self.execute(WRITE_SETPOINT, unit_code, flowrate)
+        return reply.setpoint, reply.unit_code
+
+    async def read_totalizer_status(self): #command #240
+        """ c.f. `Brooks.read_totalizer_status()`.
+        """
+        reply = await self.execute(READ_TOTALIZER_STATUS)
+        return reply.status, reply.unit_code
+
+    async def set_totalizer(self, cmd_code=0): #command #241
+        """ c.f. `Brooks.set_totalizer()`.
+        """
+        return (await self.execute(SET_TOTALIZER, cmd_code)).status
+
+    async def read_totalizer(self): #command #242
+        """ c.f. `Brooks.read_totalizer()`.
+        """
+        reply = await self.execute(READ_TOTALIZER)
+        return reply.count, reply.unit_code
+
+    async def select_flow_unit(self, flow_unit, flow_ref=0): #command #196
+        """ c.f. `Brooks.select_flow_unit()`.
+        """
+        reply = await self.execute(SELECT_FLOW_UNIT, flow_ref, flow_unit)
+        return reply == (flow_ref, flow_unit)
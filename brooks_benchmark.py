@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_benchmark.py
+# Purpose:     micro-benchmarks of the s-protocol codec and transactions
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Micro-benchmarks of the driver hot path.
+
+Run `python brooks_benchmark.py [-k filter]`. Every benchmark reports
+the number of calls per second, the peak memory traced during one call,
+i.e. what a call allocates at most at a time, and the net number of
+memory blocks left allocated per call, which is not 0 only for a leak
+or a growing cache; blocks allocated and freed within the call are not
+counted.
+Transactions run against `FakeSerial`, an in-memory port answering like
+a SLA58XX device, and against a `brooks-sim://` simulated bus, so no
+hardware is needed.
+"""
+
+import sys
+import struct
+import timeit
+import argparse
+import tracemalloc
+
+from brooks_frame import (encode_frame, pack_ascii, FrameDecoder,
+                          MASTER_DELIMITERS, DELIMITER_LONG_REPLY,
+                          DELIMITER_SHORT_REPLY)
+from brooks_commands import WRITE_SETPOINT
+import brooks_s_protocol_backend_serial
+
+TAG = '28478010'
+ADDRESS = b'\x0a\x5a\x12\x34\x56'
+
+
+class FakeSerial(object):
+    """ In-memory `serial.Serial` replacement answering as a SLA58XX.
+
+    Each request written is decoded and the matching reply is queued for
+    `read()`. Replies are precomputed by command number; command #236
+    echoes the setpoint it receives like the device does.
+
+    Args:
+        tag: tag answered to command #11.
+        address: long address of the simulated device.
+        polling_address: short address answered to command #0.
+    """
+    def __init__(self, tag=TAG, address=ADDRESS, polling_address=0):
+        self.port = 'fake://%s' % tag
+        self.timeout = None
+        self.parity = self.bytesize = self.stopbits = None
+        self.address = address
+        self.polling_address = polling_address
+        self._tag = pack_ascii(tag)
+        self._decoder = FrameDecoder(MASTER_DELIMITERS)
+        self._input = bytearray()
+        setpoint = struct.pack('>BfBf', 57, 50.0, 17, 5.0)
+        identifier = (bytes((254, address[0], address[1], 5, 5, 1, 1, 1, 0))
+                      + address[2:])
+        self._replies = {}
+        for command, data in [
+                (11, identifier),
+                (13, self._tag + pack_ascii('%-16s' % 'SLA5850')
+                 + b'\x12\x04\x78'),
+                (1, struct.pack('>Bf', 17, 4.99)),
+                (151, struct.pack('>BBfBfBfBf', 1, 92, 1.2, 32, 20.0, 12,
+                                  1.013, 17, 10.0)),
+                (235, setpoint),
+                (236, setpoint),
+                (240, bytes((1, 250))),
+                (242, struct.pack('>Bf', 250, 1234.5))]:
+            self._replies[command] = self._reply(command, data)
+        self._replies[0] = encode_frame(
+            bytes((0x80 | polling_address,)), 0, b'\x00\x00' + identifier,
+            DELIMITER_SHORT_REPLY)
+
+    def _reply(self, command, data):
+        return encode_frame(self.address, command, b'\x00\x00' + data,
+                            DELIMITER_LONG_REPLY)
+
+    @property
+    def in_waiting(self):
+        return len(self._input)
+
+    def inWaiting(self):
+        return len(self._input)
+
+    def write(self, data):
+        for frame in self._decoder.feed(data):
+            if frame.command == 11:
+                if frame.data != self._tag:
+                    continue
+            elif len(frame.address) == 1:
+                if (frame.command != 0 or
+                        frame.address[0] & 0x3f != self.polling_address):
+                    continue
+            elif frame.address != self.address:
+                continue
+            if frame.command in (196, 241):
+                reply = self._reply(frame.command, frame.data)
+            elif frame.command == 236:
+                reply = self._reply(236, b'\x39' + struct.pack('>f', 50.0)
+                                    + frame.data)
+            else:
+                reply = self._replies.get(frame.command)
+            if reply is not None:
+                self._input += reply
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
+
+    def reset_input_buffer(self):
+        del self._input[:]
+
+    def close(self):
+        pass
+
+
+def measure(func, repeat=3):
+    """ Time `func` and trace its memory use.
+
+    Returns:
+        `(calls_per_second, peak_bytes_per_call, leaked_blocks_per_call)`.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number)) / number
+    func()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks()
+    for _ in range(number):
+        func()
+    leaked = (sys.getallocatedblocks() - blocks) / number
+    return 1.0 / best, peak, leaked
+
+
+def benchmarks():
+    """ The benchmarks, as `(name, callable)` pairs.
+    """
+    device = brooks_s_protocol_backend_serial.Brooks(TAG, FakeSerial())
+    Brooks = type(device)
+    hex_command = (b'\x82' + device.address + b'\x01\x00').hex()
+    request = encode_frame(device.address, 1)
+    reply = device.ser._replies[236]
+    decoder = FrameDecoder()
+    setpoint = decoder.feed(reply)[0].data[2:]
+    hex_float = Brooks.ieee_pack(5.0)
+    simulated = Brooks(TAG, 'brooks-sim://benchmark?devices=16')
+    return [
+        ('pack (memoized)', lambda: device.pack(TAG)),
+        ('pack_ascii (uncached)', lambda: pack_ascii.__wrapped__(TAG)),
+        ('crc', lambda: device.crc(hex_command)),
+        ('ieee_pack', lambda: Brooks.ieee_pack(5.0)),
+        ('ieee_unpack', lambda: Brooks.ieee_unpack(hex_float)),
+        ('encode_frame', lambda: encode_frame(device.address, 1)),
+        ('frame cache', lambda: device._frame(1)),
+        ('decode reply', lambda: decoder.feed(reply)),
+        ('decode setpoint', lambda: WRITE_SETPOINT.decode(setpoint)),
+        ('comm2 round trip', lambda: device.comm2(1)),
+        ('read_flow', device.read_flow),
+        ('set_flow', lambda: device.set_flow(5.0)),
+        ('fake serial only', lambda: (device.ser.write(request),
+                                      device.ser.read(64))),
+        ('brooks-sim read_flow', simulated.read_flow),
+        ('brooks-sim set_flow', lambda: simulated.set_flow(5.0)),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-k', dest='filter', default='',
+                        help='only run benchmarks whose name contains this')
+    args = parser.parse_args(argv)
+    print('%-24s %14s %12s %18s' % ('benchmark', 'ops/s', 'peak B/call',
+                                    'leaked blocks/call'))
+    for name, func in benchmarks():
+        if args.filter not in name:
+            continue
+        ops, peak, leaked = measure(func)
+        print('%-24s %14.0f %12d %18.2f' % (name, ops, peak, leaked))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_bulk.py
+# Purpose:     vectorised decoding of many s-protocol replies with NumPy
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Bulk decoding of replies, i.e. replayed captures or queued responses.
+
+Instead of unpacking every reply on its own, the payloads of one command
+are gathered in a single buffer and viewed through a NumPy structured
+dtype built from the `brooks_commands` schema, floats being read as
+`>f4` at their schema offsets. Example::
+
+    values = decode_capture(open('capture.bin', 'rb').read())
+    pv = values['0a5a123456']['read_primary_variable']['pv']
+"""
+
+from collections import defaultdict
+
+import numpy as np
+
+from brooks_frame import FrameDecoder
+from brooks_commands import COMMANDS
+
+_NUMPY_FORMATS = {'B': 'u1', 'b': 'i1', 'H': '>u2', 'h': '>i2',
+                  'I': '>u4', 'i': '>i4', 'f': '>f4', 'd': '>f8'}
+_DTYPES = {}
+
+
+def response_dtype(command):
+    """ NumPy structured dtype matching the response layout of `command`.
+
+    Args:
+        command: a `brooks_commands.Command`.
+
+    Returns:
+        `numpy.dtype`, one field per schema field at the same offset.
+    """
+    dtype = _DTYPES.get(command.number)
+    if dtype is None:
+        names, formats = [], []
+        for name, fmt in command.response_fields:
+            names.append(name)
+            formats.append('S' + fmt[:-1] if fmt.endswith('s')
+                           else _NUMPY_FORMATS[fmt])
+        dtype = _DTYPES[command.number] = np.dtype({
+            'names': names,
+            'formats': formats,
+            'offsets': [command.offsets[name] for name in names],
+            'itemsize': command.response.size})
+    return dtype
+
+
+def decode_payloads(command, payloads):
+    """ Decode the response data of many replies to the same command.
+
+    Args:
+        command: a `brooks_commands.Command`.
+        payloads: iterable of bytes-like response data, status bytes
+            excluded, each at least `command.response.size` long.
+
+    Returns:
+        structured `numpy.ndarray`, one record per payload.
+
+    Raises:
+        ValueError: a payload is too short.
+    """
+    size = command.response.size
+    chunks = [memoryview(payload)[:size] for payload in payloads]
+    buffer = b''.join(chunks)
+    if len(buffer) != size * len(chunks):
+        raise ValueError('payload shorter than %d bytes for %r'
+                         % (size, command))
+    return np.frombuffer(buffer, dtype=response_dtype(command))
+
+
+def decode_frames(frames):
+    """ Decode reply frames grouped by device and command.
+
+    Replies to commands missing from `brooks_commands.COMMANDS` and
+    replies too short for their schema (error responses) are skipped.
+
+    Args:
+        frames: iterable of `brooks_frame.Frame`.
+
+    Returns:
+        `{long_address: {command_name: structured ndarray}}`, the long
+        address being an hex string.
+    """
+    grouped = defaultdict(list)
+    for frame in frames:
+        command = COMMANDS.get(frame.command)
+        if command is None or len(frame.data) - 2 < command.response.size:
+            continue
+        grouped[bytes(frame.address), command.number].append(frame.data[2:])
+    values = defaultdict(dict)
+    for (address, number), payloads in grouped.items():
+        command = COMMANDS[number]
+        values[address.hex()][command.name] = decode_payloads(command,
+                                                              payloads)
+    return dict(values)
+
+
+def decode_capture(data):
+    """ Split a raw capture of the bus in frames and decode them.
+
+    Args:
+        data: bytes-like capture, as read from the serial port.
+
+    Returns:
+        same as `decode_frames()`.
+    """
+    return decode_frames(FrameDecoder().feed(data))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_bus.py
+# Purpose:     per-port arbitration of s-protocol transactions
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" One worker thread per RS485 bus, serving a prioritised queue.
+
+The bus is half-duplex: only one transaction may be in flight. Every
+caller (GUI timer, setpoint widgets, scripts) submits its calls to the
+`Bus` of the port instead of using the devices directly; the worker runs
+them one at a time, highest priority first. Example::
+
+    manager = BusManager()
+    bus = manager.bus('/dev/ttyUSB0')
+    mfc = Brooks(tag, bus.ser)   # brooks_s_protocol_backend_serial
+    pv = bus.submit(mfc.read_flow).result()
+    bus.submit(mfc.set_flow, 5.0, priority=PRIORITY_WRITE)
+
+Submit single commands rather than `get_all_data()`, so that a setpoint
+write waits at most for one transaction.
+"""
+
+import time
+import queue
+import itertools
+import threading
+from concurrent.futures import Future
+
+from brooks_ports import open_port, release_port
+
+#: Priority of setpoint and totalizer writes.
+PRIORITY_WRITE = 0
+#: Priority of routine reads.
+PRIORITY_READ = 10
+
+
+class Bus(object):
+    """ Serialises the transactions of one serial port.
+
+    Args:
+        ser: the opened `serial.Serial`.
+        release: called by `close()` once the worker is stopped, closes
+            `ser` by default.
+    """
+    def __init__(self, ser, release=None):
+        self.ser = ser
+        self._release = release if release is not None else ser.close
+        #: Number of calls run.
+        self.transactions = 0
+        self._queue = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._busy = 0.0
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='bus %s' % ser.port)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """ Queue `func(*args, **kwargs)` to run on the bus worker.
+
+        Args:
+            func: callable doing bus I/O, i.e. `Brooks.read_flow`.
+            priority: keyword only, `PRIORITY_READ` by default; lower
+                values run first, equal values in submission order.
+
+        Returns:
+            `concurrent.futures.Future` of the result.
+        """
+        priority = kwargs.pop('priority', PRIORITY_READ)
+        future = Future()
+        self._queue.put((priority, next(self._order),
+                         (future, func, args, kwargs)))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """ Same as `submit()` but waits for and returns the result.
+        """
+        return self.submit(func, *args, **kwargs).result()
+
+    @property
+    def queue_depth(self):
+        """ Number of calls waiting for the bus.
+        """
+        return self._queue.qsize()
+
+    @property
+    def utilisation(self):
+        """ Fraction of time the bus was busy since it was created.
+        """
+        elapsed = time.monotonic() - self._started
+        return self._busy / elapsed if elapsed > 0 else 0.0
+
+    def close(self):
+        """ Stop the worker once the queued calls are done and release the
+        port.
+        """
+        self._queue.put((float('inf'), next(self._order), None))
+        self._thread.join()
+        self._release()
+
+    def _run(self):
+        while True:
+            priority, order, item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                self._busy += time.monotonic() - start
+                self.transactions += 1
+
+
+class BusManager(object):
+    """ Owns a `Bus` per serial port, the ports being shared through
+    `brooks_ports`.
+
+    Args:
+        timeout: read timeout the ports are opened with, c.f.
+            `brooks_ports.open_port()`.
+    """
+    def __init__(self, timeout=0.5):
+        self.timeout = timeout
+        self._buses = {}
+        self._lock = threading.Lock()
+
+    def bus(self, port):
+        """ The `Bus` of `port`, opened with `brooks_ports.open_port()`
+        on first use.
+        """
+        with self._lock:
+            bus = self._buses.get(port)
+            if bus is None:
+                bus = self._buses[port] = Bus(
+                    open_port(port, self.timeout), lambda: release_port(port))
+            return bus
+
+    def stats(self):
+        """ Queue depth and utilisation of every bus.
+
+        Returns:
+            `{port: {'queue_depth': int, 'utilisation': float,
+            'transactions': int}}`.
+        """
+        with self._lock:
+            buses = dict(self._buses)
+        return dict((port, {'queue_depth': bus.queue_depth,
+                            'utilisation': bus.utilisation,
+                            'transactions': bus.transactions})
+                    for port, bus in buses.items())
+
+    def close(self):
+        """ Close every bus and its port.
+        """
+        with self._lock:
+            buses, self._buses = self._buses, {}
+        for bus in buses.values():
+            bus.close()
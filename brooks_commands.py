@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_commands.py
+# Purpose:     declarative request/response layouts of the SLA58XX commands
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+
+import struct
+from collections import namedtuple
+
+#: Registered commands, by number and by name.
+COMMANDS = {}
+
+
+class Command(object):
+    """ Request and response layout of one s-protocol command.
+
+    Each layout is a list of `(field_name, struct_format)` pairs, in
+    wire order. Both are precompiled into big-endian `struct.Struct`
+    objects and the response gets its own namedtuple type.
+
+    Args:
+        number: command number.
+        name: command name, used for the reply type and registry key.
+        request: request data layout.
+        response: response data layout, status bytes excluded.
+    """
+    def __init__(self, number, name, request=(), response=()):
+        self.number = number
+        self.name = name
+        self.request = struct.Struct('>' + ''.join(f for _, f in request))
+        self.response = struct.Struct('>' + ''.join(f for _, f in response))
+        self.Reply = namedtuple(
+            ''.join(w.capitalize() for w in name.split('_')),
+            [n for n, _ in response])
+        self.response_fields = list(response)
+        self.offsets = {}
+        layout = '>'
+        for field, fmt in response:
+            self.offsets[field] = struct.calcsize(layout)
+            layout += fmt
+
+    def __repr__(self):
+        return 'Command(#%d %s)' % (self.number, self.name)
+
+    def encode(self, *args):
+        """ Pack the request data.
+
+        Returns:
+            the request data (bytes).
+        """
+        return self.request.pack(*args)
+
+    def decode(self, data, offset=0):
+        """ Unpack the response data, status bytes excluded.
+
+        Returns:
+            the `Reply` namedtuple.
+
+        Raises:
+            struct.error: `data` is too short.
+        """
+        return self.Reply._make(self.response.unpack_from(data, offset))
+
+    def decode_partial(self, data, offset=0):
+        """ Unpack a response that may end early, i.e. command #3 of a
+        device with fewer than 4 dynamic variables.
+
+        Returns:
+            the `Reply` namedtuple, the fields not received being None.
+
+        Raises:
+            struct.error: `data` does not hold the first field.
+        """
+        size = len(data) - offset
+        if size >= self.response.size:
+            return self.decode(data, offset)
+        padded = bytes(data[offset:]) + bytes(self.response.size - size)
+        reply = self.decode(padded)
+        missing = dict((field, None) for field, fmt in self.response_fields
+                       if self.offsets[field] + struct.calcsize('>' + fmt)
+                       > size)
+        if len(missing) == len(reply):
+            raise struct.error('%r: %d bytes response' % (self, size))
+        return reply._replace(**missing)
+
+
+def register(number, name, request=(), response=()):
+    """ Add a command to `COMMANDS`.
+
+    Returns:
+        the new `Command`.
+    """
+    command = Command(number, name, request, response)
+    COMMANDS[number] = command
+    COMMANDS[name] = command
+    return command
+
+
+# c.f. *SLA document* section 6-2
+READ_PRIMARY_VARIABLE = register(
+    1, 'read_primary_variable',
+    response=[('unit_code', 'B'), ('pv', 'f')])
+
+_IDENTIFIER = [('expansion', 'B'), ('manufacturer_id', 'B'),
+               ('device_type', 'B'), ('preambles', 'B'),
+               ('universal_revision', 'B'), ('transmitter_revision', 'B'),
+               ('software_revision', 'B'), ('hardware_revision', 'B'),
+               ('flags', 'B'), ('device_id', '3s')]
+
+# universal command, unique identifier, sent to a short (polling) address
+READ_UNIQUE_IDENTIFIER = register(
+    0, 'read_unique_identifier', response=_IDENTIFIER)
+
+# universal command, loop current (mA) and the 4 dynamic variables; a
+# device may return fewer variables
+READ_DYNAMIC_VARIABLES = register(
+    3, 'read_dynamic_variables',
+    response=[('current', 'f'),
+              ('pv_unit_code', 'B'), ('pv', 'f'),
+              ('sv_unit_code', 'B'), ('sv', 'f'),
+              ('tv_unit_code', 'B'), ('tv', 'f'),
+              ('qv_unit_code', 'B'), ('qv', 'f')])
+
+# universal command, unique identifier associated with the tag
+READ_UNIQUE_IDENTIFIER_BY_TAG = register(
+    11, 'read_unique_identifier_by_tag',
+    request=[('tag', '6s')],
+    response=_IDENTIFIER)
+
+# universal command, tag (packed ASCII), descriptor and date
+READ_TAG_DESCRIPTOR_DATE = register(
+    13, 'read_tag_descriptor_date',
+    response=[('tag', '6s'), ('descriptor', '12s'), ('date', '3s')])
+
+# c.f. *SLA document* section 8-6
+READ_FLOW_RANGE = register(
+    151, 'read_flow_range',
+    request=[('select_code', 'B')],
+    response=[('gas_selection_code', 'B'),
+              ('density_unit_code', 'B'), ('density', 'f'),
+              ('reference_temperature_unit_code', 'B'),
+              ('reference_temperature', 'f'),
+              ('reference_pressure_unit_code', 'B'),
+              ('reference_pressure', 'f'),
+              ('unit_code', 'B'), ('flow_range', 'f')])
+
+# c.f. *SLA document* section 8-16
+SELECT_FLOW_UNIT = register(
+    196, 'select_flow_unit',
+    request=[('flow_ref', 'B'), ('flow_unit', 'B')],
+    response=[('flow_ref', 'B'), ('flow_unit', 'B')])
+
+_SETPOINT = [('percent_unit_code', 'B'), ('setpoint_percent', 'f'),
+             ('unit_code', 'B'), ('setpoint', 'f')]
+
+# c.f. *SLA document* section 8-30
+READ_SETPOINT = register(235, 'read_setpoint', response=_SETPOINT)
+
+# c.f. *SLA document* section 8-31
+WRITE_SETPOINT = register(
+    236, 'write_setpoint',
+    request=[('unit_code', 'B'), ('setpoint', 'f')],
+    response=_SETPOINT)
+
+# c.f. *SLA document* section 8-33
+READ_TOTALIZER_STATUS = register(
+    240, 'read_totalizer_status',
+    response=[('status', 'B'), ('unit_code', 'B')])
+
+# c.f. *SLA document* section 8-34
+SET_TOTALIZER = register(
+    241, 'set_totalizer',
+    request=[('code', 'B')],
+    response=[('status', 'B')])
+
+# c.f. *SLA document* section 8-35
+READ_TOTALIZER = register(
+    242, 'read_totalizer',
+    response=[('unit_code', 'B'), ('count', 'f')])
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_discovery.py
+# Purpose:     parallel identification of the devices of several buses
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Bring up a rack of devices, one worker thread per serial port.
+
+Creating a `Brooks` blocks on its command #11 round trip. `discover()`
+identifies devices of different ports in parallel and devices of the
+same port one after the other, as the RS485 bus requires, so a rack comes
+up in the time of its busiest bus. Example::
+
+    found = discover([('28478010', '/dev/ttyUSB0'),
+                      ('28478011', '/dev/ttyUSB1')])
+    for mfc, seconds in zip(found.devices, found.timings): ...
+
+Devices created with `lazy=True` do no I/O until used; `connect_all()`
+connects such devices the same way, i.e. after the user interface is
+shown.
+
+`scan()` finds the devices without knowing their tags, by polling the
+short addresses with command #0.
+"""
+
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from brooks_frame import encode_frame, unpack_ascii, DELIMITER_SHORT
+from brooks_commands import READ_UNIQUE_IDENTIFIER, READ_TAG_DESCRIPTOR_DATE
+from brooks_ports import open_port, release_port
+from brooks_s_protocol import Brooks
+from brooks_transport import ErrorStatus, transaction
+from brooks_poller import port_of
+
+#: Result of a discovery: `devices[i]` is the i-th ready device (None on
+#: failure, the exception being in `errors[i]`) and `timings[i]` the
+#: seconds spent identifying it.
+Discovery = namedtuple('Discovery', ['devices', 'timings', 'errors'])
+
+
+def _run_per_port(groups, work):
+    """ Call `work(group)` for each of `groups`, in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(groups), 1),
+                            thread_name_prefix='discovery') as executor:
+        futures = [executor.submit(work, group) for group in groups]
+        for future in futures:
+            future.result()
+
+
+def connect_all(devices):
+    """ Connect lazy devices, in parallel across ports.
+
+    Args:
+        devices: list of devices created with `lazy=True`; `connect()` of
+            each one is called, i.e. identification and, for
+            `BrooksCustom`, the profile reads. None entries are skipped.
+
+    Returns:
+        `Discovery`, in the order of `devices`; a device that failed is
+        None in `devices` and its exception is in `errors`.
+    """
+    devices = list(devices)
+    ports = OrderedDict()
+    for index, device in enumerate(devices):
+        if device is not None:
+            ports.setdefault(port_of(device), []).append(index)
+    found = list(devices)
+    timings = [None] * len(devices)
+    errors = {}
+
+    def connect_port(indexes):
+        for index in indexes:
+            start = time.monotonic()
+            try:
+                devices[index].connect()
+            except Exception as e:
+                found[index] = None
+                errors[index] = e
+            timings[index] = time.monotonic() - start
+
+    _run_per_port(list(ports.values()), connect_port)
+    return Discovery(found, timings, errors)
+
+
+def discover(devices, factory=Brooks, address_cache=None):
+    """ Create and identify devices, in parallel across ports.
+
+    Args:
+        devices: list of `(tag, port)` pairs.
+        factory: class of the devices, called as
+            `factory(tag, port, address_cache, lazy=True)`, i.e.
+            `BrooksCustom`.
+        address_cache: optional `brooks_address_cache.AddressCache`.
+
+    Returns:
+        `Discovery`, in the order of `devices`.
+    """
+    created = []
+    errors = {}
+    for index, (tag, port) in enumerate(devices):
+        try:
+            created.append(factory(tag, port, address_cache, lazy=True))
+        except Exception as e: # i.e. the port can not be opened
+            created.append(None)
+            errors[index] = e
+    found = connect_all(created)
+    errors.update(found.errors)
+    return Discovery(found.devices, found.timings, errors)
+
+
+def scan(ports, addresses=range(16), factory=Brooks, address_cache=None,
+         timeout=0.1):
+    """ Find the devices answering command #0 on their short address,
+    in parallel across ports, and read their tag with command #13.
+
+    Each address is polled once with a short `timeout`, an address
+    without device costing just that.
+
+    Args:
+        ports: list of port names.
+        addresses: short (polling) addresses to try, 0 to 15 by default.
+        factory: class of the devices, called as
+            `factory(tag, port, long_address=address)`.
+        address_cache: optional `brooks_address_cache.AddressCache`,
+            filled with the devices found.
+        timeout: deadline in seconds of the answer to command #0.
+
+    Returns:
+        `Discovery` of the devices found, by port then address; `errors`
+        is keyed by port, or by `(port, address)` for a device found but
+        not created.
+    """
+    results = OrderedDict((port, []) for port in ports)
+    errors = {}
+
+    def scan_port(port):
+        try:
+            ser = open_port(port, timeout)
+        except Exception as e:
+            errors[port] = e
+            return
+        try:
+            for address in addresses:
+                start = time.monotonic()
+                try:
+                    response = transaction(
+                        ser, encode_frame(bytes((0x80 | address,)),
+                                          READ_UNIQUE_IDENTIFIER.number,
+                                          delimiter=DELIMITER_SHORT),
+                        timeout, attempts=1)
+                except ErrorStatus: # no device at this address
+                    continue
+                try:
+                    identity = READ_UNIQUE_IDENTIFIER.decode(response.data, 2)
+                    long_address = bytes((identity.manufacturer_id,
+                                          identity.device_type)
+                                         ) + identity.device_id
+                    device = factory(None, port, long_address=long_address)
+                    device.tag = unpack_ascii(
+                        device.execute(READ_TAG_DESCRIPTOR_DATE).tag
+                    ).rstrip()
+                    if address_cache is not None:
+                        address_cache.put(port, device.tag, long_address,
+                                          identity.manufacturer_id,
+                                          identity.device_type)
+                except Exception as e:
+                    errors[(port, address)] = e
+                    continue
+                results[port].append((device, time.monotonic() - start))
+        finally:
+            release_port(port)
+
+    _run_per_port(list(results), scan_port)
+    found = [result for port in results.values() for result in port]
+    return Discovery([device for device, _ in found],
+                     [seconds for _, seconds in found], errors)
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_emulator.py
+# Purpose:     SLA58XX devices emulated behind a pseudo-terminal
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Emulation of a RS485 bus of SLA58XX devices, without hardware.
+
+`SimulatedDevice` holds the state of one device and answers the frames
+addressed to it byte-exactly; `SimulatedBus` is a multi-drop bus of such
+devices. `PtyEmulator` serves a bus on a Linux pseudo-terminal, paced at
+the serial baud rate, so the driver is used unchanged::
+
+    with PtyEmulator(rack(4)) as emulator:
+        mfc = Brooks('28478010', emulator.port)   # i.e. '/dev/pts/5'
+        mfc.set_flow(5.0)
+
+or from a shell: `python brooks_emulator.py -n 4 --delay 0.01`. The
+asyncio driver works the same way, `AsyncTransport.open(emulator.port)`.
+
+*N.B.* ptys have no parity bit: the 8O1 settings are accepted but not
+applied, and Linux then refuses (EINVAL) to set odd parity again. The
+emulator puts the parity flags of the pty back as it created them when
+the line is idle and after every reply, so the pty can be opened again
+and again, i.e. by successive benchmark runs.
+"""
+
+import os
+import sys
+import time
+import zlib
+import tty
+import termios
+import struct
+import select
+import argparse
+import threading
+
+from brooks_frame import (pack_ascii, encode_frame, FrameDecoder,
+                          MASTER_DELIMITERS, DELIMITER_SHORT_REPLY,
+                          DELIMITER_LONG_REPLY)
+from brooks_commands import (READ_UNIQUE_IDENTIFIER, READ_PRIMARY_VARIABLE,
+                             READ_DYNAMIC_VARIABLES,
+                             READ_UNIQUE_IDENTIFIER_BY_TAG,
+                             READ_TAG_DESCRIPTOR_DATE, READ_FLOW_RANGE,
+                             SELECT_FLOW_UNIT, READ_SETPOINT, WRITE_SETPOINT,
+                             READ_TOTALIZER_STATUS, SET_TOTALIZER,
+                             READ_TOTALIZER)
+
+#: Manufacturer id and device type of the simulated devices.
+MANUFACTURER_ID = 0x0a
+DEVICE_TYPE = 0x5a
+
+#: Response code of a command the device does not know (HART).
+COMMAND_NOT_IMPLEMENTED = 64
+
+#: Setpoint and totalizer unit codes, c.f. *SLA document* section 8-33.
+PERCENT = 57
+FLOW_UNIT = 250     # same unit as the flow rate
+
+
+class SimulatedDevice(object):
+    """ State of one SLA58XX, answering s-protocol requests.
+
+    The flow follows the setpoint without delay; the totalizer integrates
+    it while it runs. The dynamic variables of command #3 are the flow,
+    the temperature, the setpoint and the total.
+
+    Args:
+        tag: 8-digits tag number.
+        polling_address: short address, answered to command #0.
+        flow_range: full scale, in the flow unit.
+        unit_code: flow unit, 17 (l/min) by default.
+        clock: time source of the totalizer, in seconds.
+    """
+    def __init__(self, tag, polling_address=0, flow_range=10.0,
+                 unit_code=17, clock=time.monotonic):
+        self.tag = tag
+        self.polling_address = polling_address
+        self.address = bytes((MANUFACTURER_ID, DEVICE_TYPE)) + struct.pack(
+            '>I', zlib.crc32(tag.encode()) & 0xffffff)[1:]
+        self.flow_range = flow_range
+        self.unit_code = unit_code
+        self.flow_ref = 0
+        self.setpoint = 0.0
+        self.totalizer_status = 0
+        self.total = 0.0
+        self.clock = clock
+        self._last = clock()
+        self._tag = pack_ascii(tag[-8:])
+        self._handlers = {
+            READ_UNIQUE_IDENTIFIER.number: self._identifier,
+            READ_UNIQUE_IDENTIFIER_BY_TAG.number: self._identifier,
+            READ_TAG_DESCRIPTOR_DATE.number: self._tag_descriptor_date,
+            READ_PRIMARY_VARIABLE.number: self._primary_variable,
+            READ_DYNAMIC_VARIABLES.number: self._dynamic_variables,
+            READ_FLOW_RANGE.number: self._flow_range,
+            SELECT_FLOW_UNIT.number: self._select_flow_unit,
+            READ_SETPOINT.number: self._read_setpoint,
+            WRITE_SETPOINT.number: self._write_setpoint,
+            READ_TOTALIZER_STATUS.number: self._totalizer_status,
+            SET_TOTALIZER.number: self._set_totalizer,
+            READ_TOTALIZER.number: self._totalizer}
+
+    @property
+    def pv(self):
+        return self.setpoint
+
+    def addressed(self, frame):
+        """ True if `frame` is a request for this device.
+        """
+        if len(frame.address) == 1:
+            return (frame.command == READ_UNIQUE_IDENTIFIER.number and
+                    frame.address[0] & 0x3f == self.polling_address)
+        if frame.command == READ_UNIQUE_IDENTIFIER_BY_TAG.number:
+            return bytes(frame.data) == self._tag
+        return (bytes(frame.address[1:]) == self.address[1:] and
+                (frame.address[0] ^ self.address[0]) & 0x3f == 0)
+
+    def answer(self, frame):
+        """ Reply frame to `frame`, None when it is not for this device.
+        """
+        if not self.addressed(frame):
+            return None
+        self._integrate()
+        handler = self._handlers.get(frame.command)
+        if handler is None:
+            data = bytes((COMMAND_NOT_IMPLEMENTED, 0))
+        else:
+            data = b'\x00\x00' + handler(bytes(frame.data))
+        if len(frame.address) == 1:
+            return encode_frame(bytes(frame.address), frame.command, data,
+                                DELIMITER_SHORT_REPLY)
+        if frame.command == READ_UNIQUE_IDENTIFIER_BY_TAG.number:
+            return encode_frame(self.address, frame.command, data,
+                                DELIMITER_LONG_REPLY)
+        return encode_frame(bytes(frame.address), frame.command, data,
+                            DELIMITER_LONG_REPLY)
+
+    def _integrate(self):
+        now = self.clock()
+        if self.totalizer_status:
+            self.total += self.pv * (now - self._last) / 60.0
+        self._last = now
+
+    def _identifier(self, data):
+        return READ_UNIQUE_IDENTIFIER.response.pack(
+            254, MANUFACTURER_ID, DEVICE_TYPE, 5, 5, 1, 1, 1, 0,
+            self.address[2:])
+
+    def _tag_descriptor_date(self, data):
+        return READ_TAG_DESCRIPTOR_DATE.response.pack(
+            self._tag, pack_ascii('%-16s' % 'SLA5850'), b'\x12\x04\x78')
+
+    def _primary_variable(self, data):
+        return READ_PRIMARY_VARIABLE.response.pack(self.unit_code, self.pv)
+
+    def _dynamic_variables(self, data):
+        return READ_DYNAMIC_VARIABLES.response.pack(
+            4.0 + 16.0 * self.pv / self.flow_range,
+            self.unit_code, self.pv, 32, 20.0, self.unit_code, self.setpoint,
+            FLOW_UNIT, self.total)
+
+    def _flow_range(self, data):
+        return READ_FLOW_RANGE.response.pack(1, 92, 1.2, 32, 20.0, 12, 1.013,
+                                             self.unit_code, self.flow_range)
+
+    def _select_flow_unit(self, data):
+        self.flow_ref, self.unit_code = SELECT_FLOW_UNIT.request.unpack(data)
+        return SELECT_FLOW_UNIT.response.pack(self.flow_ref, self.unit_code)
+
+    def _read_setpoint(self, data):
+        return READ_SETPOINT.response.pack(
+            PERCENT, 100.0 * self.setpoint / self.flow_range,
+            self.unit_code, self.setpoint)
+
+    def _write_setpoint(self, data):
+        unit_code, setpoint = WRITE_SETPOINT.request.unpack(data)
+        if unit_code == PERCENT:
+            setpoint = setpoint * self.flow_range / 100.0
+        self.setpoint = min(max(setpoint, 0.0), self.flow_range)
+        return self._read_setpoint(data)
+
+    def _totalizer_status(self, data):
+        return READ_TOTALIZER_STATUS.response.pack(self.totalizer_status,
+                                                   FLOW_UNIT)
+
+    def _set_totalizer(self, data):
+        code, = SET_TOTALIZER.request.unpack(data)
+        if code == 2: # reset, the state is kept
+            self.total = 0.0
+        else:
+            self.totalizer_status = code
+        return SET_TOTALIZER.response.pack(self.totalizer_status)
+
+    def _totalizer(self, data):
+        return READ_TOTALIZER.response.pack(FLOW_UNIT, self.total)
+
+
+def rack(count, first_tag='28478010', **kwargs):
+    """ `count` devices with consecutive tags and polling addresses.
+    """
+    return [SimulatedDevice('%08d' % (int(first_tag) + i),
+                            polling_address=i % 64, **kwargs)
+            for i in range(count)]
+
+
+class SimulatedBus(object):
+    """ Multi-drop bus of `SimulatedDevice`: decodes the master frames
+    written to it and returns the replies of the devices.
+
+    Args:
+        devices: list of `SimulatedDevice`.
+    """
+    def __init__(self, devices):
+        self.devices = list(devices)
+        self._decoder = FrameDecoder(MASTER_DELIMITERS)
+
+    def feed(self, data):
+        """ Bytes received from the master.
+
+        Returns:
+            the replies of the devices (bytes), empty until a complete
+            request is received.
+        """
+        replies = b''
+        for frame in self._decoder.feed(data):
+            for device in self.devices:
+                reply = device.answer(frame)
+                if reply is not None:
+                    replies += reply
+        return replies
+
+    def reset(self):
+        self._decoder.reset()
+
+
+class PtyEmulator(object):
+    """ Serves a `SimulatedBus` on a pseudo-terminal, from a thread.
+
+    Requests are received at the pace of the line, answered after `delay`
+    seconds and sent back one character time per byte (11 bits: start,
+    8 data, parity and stop).
+
+    Args:
+        devices: list of `SimulatedDevice`.
+        baudrate: pace of the line, 0 for no pacing.
+        delay: response delay of the devices, in seconds.
+    """
+    def __init__(self, devices, baudrate=19200, delay=0.0):
+        self.bus = SimulatedBus(devices)
+        self.baudrate = baudrate
+        self.delay = delay
+        self.port = None
+        self._master = self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def character_time(self):
+        return 11.0 / self.baudrate if self.baudrate else 0.0
+
+    def start(self):
+        """ Create the pty; `port` is the device name to open.
+        """
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave) # no echo until the driver opens the port
+        self._termios = termios.tcgetattr(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='emulator %s' % self.port)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                self._reset_parity()
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError: # no process has the port opened
+                time.sleep(0.1)
+                continue
+            time.sleep(len(data) * self.character_time)
+            replies = self.bus.feed(data)
+            if replies:
+                time.sleep(self.delay)
+                self._write(replies)
+                self._reset_parity()
+
+    def _reset_parity(self):
+        """ Parity flags of the pty as after `start()`, so that the next
+        client may set odd parity again.
+        """
+        parity = termios.PARENB | termios.PARODD
+        attributes = termios.tcgetattr(self._slave)
+        if attributes[2] & parity != self._termios[2] & parity:
+            attributes[2] = (attributes[2] & ~parity) | (self._termios[2]
+                                                         & parity)
+            termios.tcsetattr(self._slave, termios.TCSANOW, attributes)
+
+    def _write(self, data):
+        if not self.baudrate:
+            os.write(self._master, data)
+            return
+        start = time.monotonic()
+        sent = 0
+        while sent < len(data):
+            due = min(len(data), 1 + int((time.monotonic() - start)
+                                         / self.character_time))
+            if due > sent:
+                sent += os.write(self._master, data[sent:due])
+            else:
+                time.sleep(self.character_time)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('tags', nargs='*', help='tags of the devices')
+    parser.add_argument('-n', '--count', type=int, default=1,
+                        help='number of devices, without tags')
+    parser.add_argument('--baudrate', type=int, default=19200)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='response delay in seconds')
+    args = parser.parse_args(argv)
+    devices = ([SimulatedDevice(tag, i) for i, tag in enumerate(args.tags)]
+               or rack(args.count))
+    with PtyEmulator(devices, args.baudrate, args.delay) as emulator:
+        print('%d device(s) on %s: %s' % (len(devices), emulator.port,
+              ' '.join(device.tag for device in devices)))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
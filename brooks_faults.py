@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_faults.py
+# Purpose:     fault injection on a serial port, retry throughput benchmark
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Line faults of a long RS485 run, injected between the driver and the
+port.
+
+`FaultySerial` wraps a port and damages the replies it receives:
+latency and jitter, dropped replies, truncated frames, flipped bits,
+extra preamble bytes and stray echo of the request. `run()` polls a
+device through it and reports the effective transactions per second,
+the retries and the time lost. Example, 5 % of dropped replies on a
+simulated bus, with 3 attempts of 100 ms::
+
+    python brooks_faults.py --drop 0.05 --attempts 3 --timeout 0.1
+"""
+
+import sys
+import time
+import random
+import argparse
+from collections import namedtuple, deque
+
+from brooks_frame import FrameDecoder
+from brooks_s_protocol import Brooks
+
+#: Names of the faults, in the order they are applied to a reply.
+FAULTS = ('drop', 'truncate', 'flip', 'preamble', 'echo')
+
+#: Result of `run()`.
+Report = namedtuple('Report', ['transactions', 'failures', 'attempts',
+                               'retries', 'elapsed', 'time_lost',
+                               'transactions_per_second', 'faults'])
+
+
+class FaultySerial(object):
+    """ Serial port wrapper injecting faults in the replies.
+
+    The reply to each request is read completely from the wrapped port
+    during `write()`, damaged, and queued behind the bytes of the previous
+    replies not read yet; `read()` delivers it after the latency. A reply
+    later than the driver timeout thus arrives during the next
+    transaction, as on a real line, and `reset_input_buffer()` drops only
+    the bytes already arrived. Each fault is drawn independently for
+    every reply with the given probability.
+
+    Args:
+        ser: the wrapped port, i.e. a `brooks-sim://` one.
+        latency: delay of every reply, in seconds.
+        jitter: random extra delay, up to this many seconds.
+        drop: probability that the reply is lost.
+        truncate: probability that the reply is cut short.
+        flip: probability that one bit of the reply is inverted.
+        preamble: probability of 1 to 8 extra 0xFF bytes.
+        echo: probability that part of the request is echoed first.
+        seed: seed of the random generator, for repeatable runs.
+    """
+    #: Time given to the wrapped port to answer, in seconds.
+    reply_timeout = 0.5
+
+    def __init__(self, ser, latency=0.0, jitter=0.0, drop=0.0, truncate=0.0,
+                 flip=0.0, preamble=0.0, echo=0.0, seed=None):
+        self.ser = ser
+        self.latency = latency
+        self.jitter = jitter
+        self.probabilities = {'drop': drop, 'truncate': truncate,
+                              'flip': flip, 'preamble': preamble,
+                              'echo': echo}
+        #: Number of requests written.
+        self.writes = 0
+        #: Number of times each fault was injected.
+        self.injected = dict.fromkeys(FAULTS, 0)
+        self.timeout = ser.timeout
+        self._random = random.Random(seed)
+        self._pending = deque() # [ready time, bytes] of the replies
+
+    @property
+    def port(self):
+        return self.ser.port
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        return sum(len(data) for ready, data in self._pending if ready <= now)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def write(self, data):
+        self.writes += 1
+        count = self.ser.write(data)
+        reply = self._damage(bytes(data), self._receive())
+        if reply:
+            ready = (time.monotonic() + self.latency
+                     + self._random.uniform(0, self.jitter))
+            if self._pending: # the bytes keep their order on the line
+                ready = max(ready, self._pending[-1][0])
+            self._pending.append([ready, reply])
+        return count
+
+    def read(self, size=1):
+        """ Up to `size` bytes, waiting for them at most `timeout`.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            now = time.monotonic()
+            if self._pending and self._pending[0][0] <= now:
+                chunk = self._pending[0]
+                count = size - len(data)
+                data += chunk[1][:count]
+                chunk[1] = chunk[1][count:]
+                if not chunk[1]:
+                    self._pending.popleft()
+                continue
+            if deadline is not None and now >= deadline:
+                break
+            if not self._pending and deadline is None: # nothing will come
+                break
+            wake = self._pending[0][0] if self._pending else deadline
+            if deadline is not None:
+                wake = min(wake, deadline)
+            time.sleep(wake - now)
+        return bytes(data)
+
+    def reset_input_buffer(self):
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            self._pending.popleft()
+        self.ser.reset_input_buffer()
+
+    def _receive(self):
+        """ Complete reply of the wrapped port, or what came before the
+        timeout.
+        """
+        decoder = FrameDecoder()
+        deadline = time.monotonic() + self.reply_timeout
+        received = bytearray()
+        while time.monotonic() < deadline:
+            self.ser.timeout = deadline - time.monotonic()
+            data = self.ser.read(decoder.needed)
+            received += data
+            if decoder.feed(data):
+                break
+        return bytes(received)
+
+    def _happens(self, fault):
+        if self._random.random() < self.probabilities[fault]:
+            self.injected[fault] += 1
+            return True
+        return False
+
+    def _damage(self, request, reply):
+        if not reply:
+            return reply
+        if self._happens('drop'):
+            return b''
+        if len(reply) > 1 and self._happens('truncate'):
+            reply = reply[:self._random.randrange(1, len(reply))]
+        if self._happens('flip'):
+            reply = bytearray(reply)
+            reply[self._random.randrange(len(reply))] ^= (
+                1 << self._random.randrange(8))
+            reply = bytes(reply)
+        if self._happens('preamble'):
+            reply = b'\xff' * self._random.randint(1, 8) + reply
+        if self._happens('echo'):
+            reply = request[:self._random.randint(1, len(request))] + reply
+        return reply
+
+
+def run(device, count=500, read=None):
+    """ Poll `device` `count` times and measure the cost of the faults.
+
+    The time lost is the elapsed time minus `count` times the duration of
+    a clean transaction, measured first with the faults disabled.
+
+    Args:
+        device: a `Brooks` whose `ser` is a `FaultySerial`.
+        count: number of transactions.
+        read: function called with the device, returning True on
+            success; `read_flow()` not returning -1 by default.
+
+    Returns:
+        `Report`.
+    """
+    if read is None:
+        read = lambda device: device.read_flow() != -1
+    ser = device.ser
+    probabilities, ser.probabilities = (ser.probabilities,
+                                        dict.fromkeys(FAULTS, 0.0))
+    jitter = ser.jitter
+    ser.jitter = 0.0
+    start = time.monotonic()
+    for _ in range(10):
+        read(device)
+    clean = (time.monotonic() - start) / 10 + jitter / 2
+    ser.probabilities, ser.jitter = probabilities, jitter
+    injected = dict(ser.injected)
+    writes = ser.writes
+    failures = 0
+    start = time.monotonic()
+    for _ in range(count):
+        if not read(device):
+            failures += 1
+    elapsed = time.monotonic() - start
+    attempts = ser.writes - writes
+    return Report(count, failures, attempts, attempts - count, elapsed,
+                  max(elapsed - count * clean, 0.0), count / elapsed,
+                  dict((fault, ser.injected[fault] - injected[fault])
+                       for fault in FAULTS))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', default='brooks-sim://faults?devices=1')
+    parser.add_argument('--tag', default='28478010')
+    parser.add_argument('-n', '--count', type=int, default=500)
+    parser.add_argument('--attempts', type=int, default=Brooks.attempts)
+    parser.add_argument('--timeout', type=float, default=Brooks.timeout)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    for fault in FAULTS:
+        parser.add_argument('--' + fault, type=float, default=0.0,
+                            help='probability of the fault per reply')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+    device = Brooks(args.tag, args.port, lazy=True)
+    device.attempts = args.attempts
+    device.timeout = args.timeout
+    device.ser = FaultySerial(device.ser, args.latency, args.jitter,
+                              seed=args.seed, **dict(
+                                  (fault, getattr(args, fault))
+                                  for fault in FAULTS))
+    device.connect()
+    report = run(device, args.count)
+    print('transactions  %8d  (%d failed)' % (report.transactions,
+                                             report.failures))
+    print('attempts      %8d  (%d retries)' % (report.attempts,
+                                              report.retries))
+    print('elapsed       %8.3f s' % report.elapsed)
+    print('time lost     %8.3f s' % report.time_lost)
+    print('throughput    %8.1f transactions/s'
+          % report.transactions_per_second)
+    print('faults        %s' % ', '.join('%s %d' % (fault,
+                                                    report.faults[fault])
+                                         for fault in FAULTS))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_frame.py
+# Purpose:     binary frame codec for the Brooks s-protocol (HART based)
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+
+from collections import namedtuple, OrderedDict
+from functools import lru_cache, reduce
+from operator import xor
+
+#: Number of 0xFF preamble bytes sent ahead of every master frame.
+PREAMBLE_LENGTH = 4
+PREAMBLE = b'\xff' * PREAMBLE_LENGTH
+
+#: Delimiters, c.f. *SLA document* section 3-4-8-1.
+DELIMITER_SHORT = 0x02          # master to slave, polling (1 byte) address
+DELIMITER_LONG = 0x82           # master to slave, long (5 bytes) address
+DELIMITER_SHORT_REPLY = 0x06    # slave to master, polling address
+DELIMITER_LONG_REPLY = 0x86     # slave to master, long address
+MASTER_DELIMITERS = (DELIMITER_SHORT, DELIMITER_LONG)
+REPLY_DELIMITERS = (DELIMITER_SHORT_REPLY, DELIMITER_LONG_REPLY)
+
+#: Broadcast long address used by command #11.
+BROADCAST_ADDRESS = b'\x80\x00\x00\x00\x00'
+
+#: The 64 characters of the packed-ASCII (6-bit) character set, by code.
+PACKED_ASCII = ''.join(chr(c | 0x40 if c < 0x20 else c) for c in range(64))
+
+#: A decoded frame. `address` and `data` are memoryview slices of the
+#: received buffer; for slave replies `data` starts with the 2 status bytes.
+Frame = namedtuple('Frame', ['delimiter', 'address', 'command', 'data'])
+
+
+class FrameError(Exception):
+    """ Raised when a received frame is truncated or malformed.
+    """
+    pass
+
+
+class ChecksumError(FrameError):
+    """ Raised when a complete frame is received with a wrong checksum.
+    """
+    pass
+
+
+def address_length(delimiter):
+    """ Length of the address field announced by `delimiter`: 5 bytes for
+    long frames, 1 byte for short (polling address) frames.
+    """
+    return 5 if delimiter & 0x80 else 1
+
+
+@lru_cache(maxsize=256)
+def pack_ascii(text):
+    """ Turns a string in packed-ascii format.
+
+    c.f. *SLA document* page (21), section 3-4-8-5 Packed-ASCII (6-bit
+    ASCII) Data Format. Every 4 characters are packed in 3 bytes; the
+    text is upper-cased and padded with spaces to a multiple of 4
+    characters. Results are memoized, tags being packed over and over.
+
+    Args:
+        text: the ascii text to pack, i.e. the 8-characters tag `12345678`.
+
+    Returns:
+        the packed text (bytes).
+    """
+    text = text.upper()
+    text += ' ' * (-len(text) % 4)
+    value = 0
+    for c in text:
+        value = (value << 6) | (ord(c) & 0x3f)
+    return value.to_bytes(len(text) * 3 // 4, 'big')
+
+
+@lru_cache(maxsize=256)
+def _unpack_ascii(data):
+    value = int.from_bytes(data, 'big')
+    shift = len(data) * 8
+    text = []
+    while shift >= 6:
+        shift -= 6
+        text.append(PACKED_ASCII[(value >> shift) & 0x3f])
+    return ''.join(text)
+
+
+def unpack_ascii(data):
+    """ Decode packed-ascii text, i.e. tags, messages and descriptors read
+    back from the device. Trailing spaces are kept.
+
+    Args:
+        data: bytes-like packed text, 3 bytes per 4 characters.
+
+    Returns:
+        the text (str).
+    """
+    return _unpack_ascii(bytes(data))
+
+
+def checksum(data):
+    """ Longitudinal parity (XOR) of `data`.
+
+    c.f. *SLA document* page (22), section 3-4-8-6 Checksum Characters
+
+    Args:
+        data: bytes-like object, from the delimiter up to the last data byte.
+
+    Returns:
+        the checksum (int).
+    """
+    return reduce(xor, data, 0)
+
+
+def encode_message(message):
+    """ Wrap a message with the preamble, checksum and pad byte.
+
+    Args:
+        message: bytes-like message, from the delimiter up to the last
+            data byte.
+
+    Returns:
+        the encoded frame (bytes).
+    """
+    return PREAMBLE + bytes(message) + bytes((checksum(message), 0))
+
+
+def encode_frame(address, command, data=b'', delimiter=DELIMITER_LONG):
+    """ Build a complete master frame ready to be written on the bus.
+
+    The frame is: preamble, delimiter, address, command, byte count,
+    data, checksum and a trailing pad byte.
+
+    Args:
+        address: bytes-like long (5 bytes) or polling (1 byte) address.
+        command: command number (int).
+        data: bytes-like request data.
+        delimiter: frame delimiter, long frame by default.
+
+    Returns:
+        the encoded frame (bytes).
+    """
+    frame = bytearray(PREAMBLE)
+    frame.append(delimiter)
+    frame += address
+    frame.append(command)
+    frame.append(len(data))
+    frame += data
+    frame.append(checksum(memoryview(frame)[PREAMBLE_LENGTH:]))
+    frame.append(0)
+    return bytes(frame)
+
+
+def parse_frame(buffer):
+    """ Decode the first frame found in `buffer` without copying it.
+
+    The 0xFF preamble is skipped, then the delimiter, address, command,
+    byte count and data are read as slices of a memoryview over `buffer`.
+
+    Args:
+        buffer: bytes-like object holding the received bytes.
+
+    Returns:
+        `Frame` (delimiter, address, command, data).
+
+    Raises:
+        FrameError: no delimiter or the frame is truncated.
+    """
+    view = memoryview(buffer)
+    n = len(view)
+    i = 0
+    while i < n and view[i] == 0xff:
+        i += 1
+    if i == n:
+        raise FrameError('no delimiter found')
+    delimiter = view[i]
+    start = i + 1 + address_length(delimiter)
+    if start + 2 > n:
+        raise FrameError('truncated header')
+    command, byte_count = view[start], view[start + 1]
+    end = start + 2 + byte_count
+    if end > n:
+        raise FrameError('truncated data, %d of %d bytes'
+                         % (n - start - 2, byte_count))
+    return Frame(delimiter, view[i + 1:start], command, view[start + 2:end])
+
+
+def is_reply_to(reply, request):
+    """ True if `reply` answers `request`: same command, from the
+    addressed device. Command #11 is sent to the broadcast address and
+    answered from the address of the device. The master and burst mode
+    bits of the first address byte are ignored.
+
+    Args:
+        reply: the received `Frame`.
+        request: the `Frame` of the request, i.e. `parse_frame(bytes)`.
+    """
+    if reply.command != request.command:
+        return False
+    if request.address == BROADCAST_ADDRESS:
+        return True
+    return (len(reply.address) == len(request.address) and
+            reply.address[1:] == request.address[1:] and
+            (reply.address[0] ^ request.address[0]) & 0x3f == 0)
+
+
+class FrameCache(object):
+    """ Encoded request frames, by (address, command, data).
+
+    Frames without data are constant and kept for the lifetime of the
+    cache; frames with data (i.e. setpoints) are kept in a bounded LRU.
+
+    Args:
+        size: maximum number of frames with data kept.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self._constant = {}
+        self._lru = OrderedDict()
+
+    def get(self, address, command, data=b''):
+        """ Encoded frame, built by `encode_frame()` on a cache miss.
+
+        Args:
+            address: bytes long address.
+            command: command number (int).
+            data: bytes request data.
+
+        Returns:
+            the frame (bytes), ready for `ser.write()`.
+        """
+        key = (address, command, data)
+        if not data:
+            frame = self._constant.get(key)
+            if frame is None:
+                frame = self._constant[key] = encode_frame(address, command)
+            return frame
+        frame = self._lru.get(key)
+        if frame is None:
+            if len(self._lru) >= self.size:
+                self._lru.popitem(last=False)
+            frame = self._lru[key] = encode_frame(address, command, data)
+        else:
+            self._lru.move_to_end(key)
+        return frame
+
+    def clear(self):
+        self._constant.clear()
+        self._lru.clear()
+
+
+class FrameDecoder(object):
+    """ Incremental frame decoder fed with arbitrary chunks of bytes.
+
+    A frame is recognised as at least one 0xFF preamble byte followed by
+    one of the accepted delimiters. Once the byte count is known the
+    decoder waits for the whole frame and checks its checksum. Anything
+    else (noise, echoes of our own requests, frames with a wrong
+    checksum) is skipped one byte at a time, so the decoder resynchronises
+    on the next preamble without losing the frame that follows. Frames
+    dropped for a wrong checksum are counted in `checksum_errors`.
+
+    Args:
+        delimiters: the accepted delimiters, replies from slaves by default.
+    """
+    def __init__(self, delimiters=REPLY_DELIMITERS):
+        self.delimiters = frozenset(delimiters)
+        self.buffer = bytearray()
+        #: Minimum number of bytes still missing to complete a frame.
+        self.needed = 1
+        #: Number of bytes dropped outside of frames, preambles included.
+        self.discarded = 0
+        #: Number of complete frames dropped for a wrong checksum.
+        self.checksum_errors = 0
+
+    def reset(self):
+        """ Drop any partially received frame.
+        """
+        del self.buffer[:]
+        self.needed = 1
+
+    def feed(self, data):
+        """ Add received bytes and return the frames they complete.
+
+        Args:
+            data: bytes-like chunk, of any length.
+
+        Returns:
+            list of `Frame`, possibly empty.
+        """
+        self.buffer += data
+        frames = []
+        frame = self._next()
+        while frame is not None:
+            frames.append(frame)
+            frame = self._next()
+        return frames
+
+    def _next(self):
+        buffer = self.buffer
+        position = 0
+        pending = None
+        while True:
+            start, i, end = self._candidate(position)
+            if end is None:
+                break
+            if end > len(buffer):
+                # incomplete, but a complete frame may follow a garbage header
+                if pending is None:
+                    pending = start, end
+                position = i + 1
+                continue
+            with memoryview(buffer) as view:
+                valid = checksum(view[i:end - 1]) == buffer[end - 1]
+            if not valid:
+                if pending is None:
+                    self.checksum_errors += 1
+                position = i + 1
+                continue
+            raw = bytes(buffer[i:end - 1])
+            self._skip(start)
+            del buffer[:end - start]
+            self.needed = 1
+            return parse_frame(raw)
+        if pending is None:
+            self._skip(start)
+            self.needed = 1
+        else:
+            self._skip(pending[0])
+            self.needed = pending[1] - pending[0] - len(buffer)
+        return None
+
+    def _candidate(self, position):
+        """ Locate the next preamble and accepted delimiter from `position`.
+
+        Returns:
+            `(start, i, end)`: index of the preamble, of the delimiter and
+            end of the frame. `end` is None when no delimiter is found, in
+            which case bytes before `start` are garbage; it may be past the
+            end of the buffer while the frame is incomplete.
+        """
+        buffer = self.buffer
+        n = len(buffer)
+        while True:
+            start = buffer.find(0xff, position)
+            if start < 0:
+                return n, None, None
+            i = start
+            while i < n and buffer[i] == 0xff:
+                i += 1
+            if i == n:
+                return start, None, None
+            delimiter = buffer[i]
+            if delimiter not in self.delimiters:
+                position = i + 1
+                continue
+            header = i + 1 + address_length(delimiter) + 2
+            if n < header:
+                return start, i, header
+            return start, i, header + buffer[header - 1] + 1
+
+    def _skip(self, count):
+        self.discarded += count
+        del self.buffer[:count]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_history.py
+# Purpose:     preallocated ring buffer of the samples, for plotting
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Sample history in one preallocated NumPy structured array.
+
+Appending a sample writes one record, nothing is allocated nor moved; the
+last samples are read back in time order as a view of the array, without
+copy::
+
+    history = RingBuffer(36000)           # 1 hour at 10 Hz
+    history.append(time.time(), 0, pv, sp)
+    curve.setData(history.last(300)['pv'])
+
+Each record is stored twice, at `i` and `i + capacity`, so that any run
+of the last samples is contiguous in memory.
+"""
+
+import numpy as np
+
+#: Record of a sample: time (s), device index, pv, sp and flags.
+SAMPLE_DTYPE = np.dtype([('time', '<f8'), ('device', '<u2'), ('pv', '<f4'),
+                         ('sp', '<f4'), ('flags', 'u1')])
+
+#: Flags of a sample.
+FLAG_ERROR = 0x01   # the read failed, pv and sp are the last known values
+
+
+class RingBuffer(object):
+    """ Fixed capacity history of samples, the oldest being overwritten.
+
+    Args:
+        capacity: number of samples kept.
+        dtype: record type, `SAMPLE_DTYPE` by default.
+    """
+    def __init__(self, capacity, dtype=SAMPLE_DTYPE):
+        self.capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, *record):
+        """ Add a sample, i.e. `append(time, device, pv, sp, flags)`;
+        missing trailing fields are 0.
+        """
+        if len(record) < len(self._data.dtype):
+            record += (0,) * (len(self._data.dtype) - len(record))
+        self._data[self._next] = record
+        self._data[self._next + self.capacity] = record
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def last(self, n=None):
+        """ The last `n` samples (all by default), oldest first.
+
+        Returns:
+            a read-only view of the buffer, valid until `n` more samples
+            are appended; i.e. `last(300)['pv']`.
+        """
+        if n is None or n > self._count:
+            n = self._count
+        end = self._next + self.capacity
+        view = self._data[end - n:end]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
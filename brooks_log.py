@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_log.py
+# Purpose:     append-only binary log of the samples, memory-mapped reader
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" On-disk time series of the samples, one directory per device.
+
+Every sample is a fixed-width record of `LOG_DTYPE` (19 bytes): monotonic
+time in ns, device id, pv, sp and status flags, appended to the current
+chunk of the device. A new chunk is started every `chunk_duration`
+seconds of wall clock (one day by default, aligned on UTC midnight) or
+after `chunk_records` records::
+
+    log/
+        00000/
+            20261018T000000.000012Z.brl
+            20261019T000000.000007Z.brl
+        00001/
+            ...
+
+A chunk is a 32 bytes header followed by the records, so it is opened
+with `numpy.memmap` without parsing nor copy::
+
+    reader = LogReader('log')
+    for records in reader.read(0, start, start + 86400):   # views
+        plot(records['pv'])
+
+At 10 Hz a device writes 16.4 MB a day, against about 45 MB for the same
+samples in CSV.
+"""
+
+import os
+import sys
+import time
+import struct
+import argparse
+import threading
+
+import numpy as np
+
+from brooks_history import FLAG_ERROR
+
+#: Record of a sample: monotonic time (ns), device id, pv, sp and status
+#: flags (c.f. `brooks_history.FLAG_ERROR`), packed, little endian.
+LOG_DTYPE = np.dtype([('time', '<i8'), ('device', '<u2'), ('pv', '<f4'),
+                      ('sp', '<f4'), ('status', 'u1')])
+
+_RECORD = struct.Struct('<qHffB')
+assert _RECORD.size == LOG_DTYPE.itemsize
+
+#: Header of a chunk: magic, then wall clock and monotonic time (ns) taken
+#: together when the chunk was created.
+MAGIC = b'BRKLOG\x00\x01'
+_HEADER = struct.Struct('<8sqq8x')
+HEADER_SIZE = _HEADER.size
+
+#: Extension of the chunk files.
+SUFFIX = '.brl'
+
+
+def device_directory(directory, device):
+    return os.path.join(directory, '%05d' % device)
+
+
+class LogWriter(object):
+    """ Appends the samples to the chunks of each device.
+
+    Writes are buffered and flushed every `flush_interval` seconds; after
+    a crash, a record cut short at the end of a chunk is ignored by the
+    reader.
+
+    Args:
+        directory: root of the log, created if needed.
+        chunk_duration: wall clock seconds per chunk.
+        chunk_records: maximum number of records per chunk, None for no
+            limit.
+        flush_interval: seconds between two flushes of the files.
+    """
+    def __init__(self, directory, chunk_duration=86400, chunk_records=None,
+                 flush_interval=1.0):
+        self.directory = directory
+        self.chunk_duration = chunk_duration
+        self.chunk_records = chunk_records
+        self.flush_interval = flush_interval
+        self._chunks = {}   # device: [file, key, records, wall, monotonic]
+        self._last = {}     # device: [pv, sp], for `sample()`
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, device, pv, sp, status=0, time_ns=None):
+        """ Write one sample.
+
+        Args:
+            device: device id, 0 to 65535.
+            pv: flow rate.
+            sp: setpoint.
+            status: flags, i.e. `FLAG_ERROR`.
+            time_ns: `time.monotonic_ns()` of the read, now by default.
+        """
+        if time_ns is None:
+            time_ns = time.monotonic_ns()
+        record = _RECORD.pack(time_ns, device, pv, sp, status)
+        with self._lock:
+            chunk = self._chunk(device, time_ns)
+            chunk[0].write(record)
+            chunk[2] += 1
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def sample(self, sample):
+        """ `brooks_scheduler.AcquisitionScheduler` subscriber: writes a
+        record for every 'pv' sample, with the last 'sp' read. A failed
+        read is written with the last known values and `FLAG_ERROR`.
+        """
+        if sample.variable not in ('pv', 'sp'):
+            return
+        last = self._last.setdefault(sample.device, [0.0, 0.0])
+        if sample.variable == 'sp':
+            if sample.error is None:
+                last[1] = sample.value
+            return
+        status = 0
+        if sample.error is None:
+            last[0] = sample.value
+        else:
+            status = FLAG_ERROR
+        self.append(sample.device, last[0], last[1], status,
+                    int(sample.monotonic * 1e9))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            for chunk in self._chunks.values():
+                chunk[0].close()
+            self._chunks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _flush(self):
+        for chunk in self._chunks.values():
+            chunk[0].flush()
+        self._flushed = time.monotonic()
+
+    def _chunk(self, device, time_ns):
+        """ Chunk of `device` for a record at `time_ns`, a new one when
+        the current one is full or of an other period.
+        """
+        chunk = self._chunks.get(device)
+        if chunk is not None:
+            wall = chunk[3] + time_ns - chunk[4]
+            if (wall // (self.chunk_duration * 10**9) == chunk[1] and
+                    (self.chunk_records is None or
+                     chunk[2] < self.chunk_records)):
+                return chunk
+            chunk[0].close()
+        wall, monotonic = time.time_ns(), time.monotonic_ns()
+        path = os.path.join(device_directory(self.directory, device),
+                            time.strftime('%Y%m%dT%H%M%S', time.gmtime(
+                                wall // 10**9))
+                            + '.%06dZ' % (wall // 1000 % 10**6) + SUFFIX)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'xb')
+        f.write(_HEADER.pack(MAGIC, wall, monotonic))
+        chunk = [f, (wall + time_ns - monotonic)
+                 // (self.chunk_duration * 10**9), 0, wall, monotonic]
+        self._chunks[device] = chunk
+        return chunk
+
+
+class Chunk(object):
+    """ One chunk file, its records memory-mapped read-only.
+
+    Args:
+        path: file of the chunk.
+
+    Raises:
+        ValueError: not a chunk file.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+            raise ValueError('not a brooks log chunk: %r' % path)
+        _, self.wall_ns, self.monotonic_ns = _HEADER.unpack(header)
+        count = (os.path.getsize(path) - HEADER_SIZE) // LOG_DTYPE.itemsize
+        if count:
+            #: `LOG_DTYPE` records, a `numpy.memmap`.
+            self.records = np.memmap(path, LOG_DTYPE, 'r', HEADER_SIZE,
+                                     (count,))
+        else:
+            self.records = np.zeros(0, LOG_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def wall_time(self, records=None):
+        """ Wall clock time of the records (all by default), in seconds
+        since the epoch; a new array.
+        """
+        if records is None:
+            records = self.records
+        return (records['time'] - self.monotonic_ns + self.wall_ns) / 1e9
+
+    def index(self, wall):
+        """ Index of the first record at or after `wall` (seconds since
+        the epoch), by bisection: only a few pages are read.
+        """
+        target = int(wall * 1e9) - self.wall_ns + self.monotonic_ns
+        times = self.records['time']
+        low, high = 0, len(times)
+        while low < high:
+            middle = (low + high) // 2
+            if times[middle] < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def between(self, start=None, end=None):
+        """ Records from `start` included to `end` excluded (seconds since
+        the epoch, None for no limit), a view.
+        """
+        first = 0 if start is None else self.index(start)
+        last = len(self.records) if end is None else self.index(end)
+        return self.records[first:last]
+
+
+class LogReader(object):
+    """ Reads the log written by `LogWriter`.
+
+    Args:
+        directory: root of the log.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def devices(self):
+        """ Ids of the logged devices.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name) for name in os.listdir(self.directory)
+                      if name.isdigit())
+
+    def chunks(self, device):
+        """ `Chunk` of `device`, oldest first.
+        """
+        directory = device_directory(self.directory, device)
+        if not os.path.isdir(directory):
+            return []
+        return [Chunk(os.path.join(directory, name))
+                for name in sorted(os.listdir(directory))
+                if name.endswith(SUFFIX)]
+
+    def read(self, device, start=None, end=None):
+        """ Records of `device` from `start` included to `end` excluded
+        (seconds since the epoch, None for no limit).
+
+        Returns:
+            list of `LOG_DTYPE` views, one per chunk, without copy; a day
+            within daily chunks is a single view. `numpy.concatenate()`
+            them for one array.
+        """
+        views = []
+        for chunk in self.chunks(device):
+            if end is not None and chunk.wall_ns >= end * 1e9:
+                break
+            records = chunk.between(start, end)
+            if len(records):
+                views.append(records)
+        return views
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', help='root of the log')
+    args = parser.parse_args(argv)
+    reader = LogReader(args.directory)
+    for device in reader.devices():
+        for chunk in reader.chunks(device):
+            if len(chunk):
+                first, last = chunk.wall_time(chunk.records[[0, -1]])
+                period = '%s .. %s' % (
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(first)),
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(last)))
+            else:
+                period = 'empty'
+            print('%5d  %s  %9d records  %s' % (
+                device, os.path.basename(chunk.path), len(chunk), period))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_poller.py
+# Purpose:     parallel polling of devices spread over several serial ports
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Poll a fleet of devices, one worker thread per serial port.
+
+Devices on the same port are read one after the other, as the RS485 bus
+requires; ports are independent and are read in parallel, so a cycle
+lasts as long as the busiest bus. Example::
+
+    poller = FleetPoller(mfcs)
+    snapshot = poller.poll()
+    for mfc, pv in zip(mfcs, snapshot.values): ...
+"""
+
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+#: Result of one polling cycle: `values[i]` is the reading of the i-th
+#: device (None on failure, the exception being in `errors[i]`).
+Snapshot = namedtuple('Snapshot', ['timestamp', 'duration', 'values',
+                                   'errors'])
+
+
+def port_of(device):
+    """ Name of the port `device` is on, used to group devices by bus.
+
+    Devices without a serial port (i.e. simulations) get a bus of their own.
+    """
+    ser = getattr(device, 'ser', None)
+    if ser is None:
+        return id(device)
+    return getattr(ser, 'port', None) or id(ser)
+
+
+def read_flow(device):
+    return device.read_flow()
+
+
+class FleetPoller(object):
+    """ Polls devices grouped by port in a `ThreadPoolExecutor`.
+
+    Args:
+        devices: list of devices, i.e. `Brooks` instances.
+        read: function called with each device, returning its reading;
+            `device.read_flow()` by default.
+    """
+    def __init__(self, devices, read=read_flow):
+        self.devices = list(devices)
+        self.read = read
+        self.ports = OrderedDict()
+        for index, device in enumerate(self.devices):
+            self.ports.setdefault(port_of(device), []).append(index)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(len(self.ports), 1),
+            thread_name_prefix='poller')
+
+    def poll(self):
+        """ Read every device once.
+
+        Returns:
+            `Snapshot` taken at `timestamp` (`time.time()`, start of the
+            cycle) and lasting `duration` seconds.
+        """
+        timestamp = time.time()
+        start = time.monotonic()
+        values = [None] * len(self.devices)
+        errors = {}
+        futures = [self._executor.submit(self._poll_port, indexes, values,
+                                         errors)
+                   for indexes in self.ports.values()]
+        for future in futures:
+            future.result()
+        return Snapshot(timestamp, time.monotonic() - start, values, errors)
+
+    def _poll_port(self, indexes, values, errors):
+        for index in indexes:
+            try:
+                values[index] = self.read(self.devices[index])
+            except Exception as e:
+                errors[index] = e
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_ports.py
+# Purpose:     process-wide registry of the opened serial ports
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Reference counted serial ports.
+
+Several devices on the same RS485 line share one `serial.Serial`. The
+first `open_port()` of a port opens it with the s-protocol settings,
+the following ones return the same object; the port is closed when every
+`open_port()` has been balanced by a `release_port()`.
+
+Importing this module registers the URL handlers of `brooks_urlhandler`,
+i.e. `brooks-sim://rack1?devices=16` for a simulated bus.
+"""
+
+import threading
+
+import serial
+
+if 'brooks_urlhandler' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('brooks_urlhandler')
+
+_ports = {}
+_lock = threading.Lock()
+
+
+def open_port(port, timeout=None):
+    """ Open `port`, or share it if it is already opened.
+
+    The port is opened with `serial.serial_for_url()` at 19200 baud, odd
+    parity, 8 data bits and 1 stop bit, so pyserial URLs work too.
+
+    Args:
+        port: device name or URL, i.e. `/dev/ttyUSB0` or `COM2`.
+        timeout: read timeout, the deadline of the transactions, so that
+            the port is not reconfigured by the first one; ignored when
+            the port is already opened.
+
+    Returns:
+        the shared `serial.Serial`.
+
+    Raises:
+        serial.SerialException: the port can not be opened.
+    """
+    with _lock:
+        entry = _ports.get(port)
+        if entry is None:
+            ser = serial.serial_for_url(port, 19200,
+                                        parity=serial.PARITY_ODD,
+                                        bytesize=serial.EIGHTBITS,
+                                        stopbits=serial.STOPBITS_ONE,
+                                        timeout=timeout)
+            entry = _ports[port] = [ser, 0]
+        entry[1] += 1
+        return entry[0]
+
+
+def release_port(port):
+    """ Give back a port obtained with `open_port()`, closing it when
+    this was the last user.
+
+    Args:
+        port: the name given to `open_port()`.
+    """
+    with _lock:
+        entry = _ports.get(port)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _ports[port]
+            entry[0].close()
+
+
+def users(port):
+    """ Number of users of `port`, 0 when it is not opened.
+    """
+    with _lock:
+        entry = _ports.get(port)
+        return entry[1] if entry is not None else 0
@@ -11,19 +11,19 @@
 # Website:     https://github.com/CINF/PyExpLabSys/blob/master/PyExpLabSys/drivers/brooks_s_protocol.py
 #-------------------------------------------------------------------------------
 
-import time
 import struct
 import logging
-import serial
-from six import b, indexbytes
-
-class ErrorStatus(Exception):
-    """ Example:
-    ```python
-    raise ErrorStatus('blabla...')
-    ```
-    """
-    pass
+import weakref
+
+from brooks_frame import (checksum, pack_ascii, encode_frame, encode_message,
+                          FrameCache, BROADCAST_ADDRESS)
+from brooks_ports import open_port, release_port
+from brooks_transport import ErrorStatus, transaction
+from brooks_commands import (READ_PRIMARY_VARIABLE, READ_DYNAMIC_VARIABLES,
+                             READ_UNIQUE_IDENTIFIER_BY_TAG, READ_FLOW_RANGE,
+                             SELECT_FLOW_UNIT, READ_SETPOINT, WRITE_SETPOINT,
+                             READ_TOTALIZER_STATUS, SET_TOTALIZER,
+                             READ_TOTALIZER)
 
 class Brooks(object):
     """ Driver for Brooks s-protocol series SLA58XX.
@@ -32,21 +32,114 @@ class Brooks(object):
     for implementing the below class methods. In the rest of this help, 
     *SLA document* will be referenced to this document.
 
+    The port is opened through `brooks_ports`, so devices on the same
+    port share it; it is released by `close()` or when the instance is
+    garbage collected.
+
+    The long address is read with command #11, unless it is found in
+    `address_cache`. A cached address is checked by the first transaction:
+    if the device does not answer at that address it is identified again.
+
+    A `lazy` device does no bus I/O in the constructor: it is identified
+    by its first command, or by `connect()` (c.f.
+    `brooks_discovery.connect_all()` to connect many devices at once).
+
     Args:
         tag: 8-digits tag number
         port: comport
+        address_cache: optional `brooks_address_cache.AddressCache`.
+        long_address: optional known long address (bytes or hex string),
+            skips the identification.
+        lazy: if True, the identification is deferred to the first use.
     """
-    def __init__(self, tag, port='/dev/ttyUSB0'):
-        self.ser = serial.Serial(port, 19200)
-        self.ser.parity = serial.PARITY_ODD
-        self.ser.bytesize = serial.EIGHTBITS
-        self.ser.stopbits = serial.STOPBITS_ONE
-        deviceid = self.comm('8280000000000b06'
-                             + self.pack(tag[-8:]))
-        manufactor_code = deviceid[6:8]
-        device_type = deviceid[8:10]
-        long_address = manufactor_code + device_type + deviceid[-6:]
-        self.long_address = long_address
+    #: Number of request frames with data (i.e. `set_flow`) kept encoded.
+    frame_cache_size = 32
+    #: Deadline in seconds for receiving a complete response frame.
+    timeout = 0.5
+    #: Number of times a request is sent before giving up.
+    attempts = 9
+
+    def __init__(self, tag, port='/dev/ttyUSB0', address_cache=None,
+                 long_address=None, lazy=False):
+        self.ser = open_port(port, self.timeout) # shared with the other devices of the port
+        self._release = weakref.finalize(self, release_port, port)
+        self._setup(tag, address_cache, long_address, lazy)
+
+    def _setup(self, tag, address_cache, long_address, lazy):
+        """ Device state, once `self.ser` and `self._release` are set.
+        """
+        self._frames = FrameCache(self.frame_cache_size)
+        self.tag = tag
+        self.address_cache = address_cache
+        identity = None
+        if address_cache is not None:
+            identity = address_cache.get(self.ser.port, tag)
+        if long_address is not None:
+            if isinstance(long_address, str):
+                long_address = bytes.fromhex(long_address)
+            self.address = bytes(long_address)
+            self._verified = True
+        elif identity is None:
+            self.address = None
+            self._verified = True
+            if not lazy:
+                self.identify()
+        else:
+            self.address = bytes.fromhex(identity['long_address'])
+            self._verified = False
+
+    def identify(self):
+        """ Read the long address of the device by its tag (command #11)
+        and store it in the address cache.
+
+        Returns:
+            the command #11 `Reply`.
+        """
+        command = READ_UNIQUE_IDENTIFIER_BY_TAG
+        response = self._transaction(encode_frame(
+            BROADCAST_ADDRESS, command.number,
+            command.encode(pack_ascii(self.tag[-8:])))).data
+        deviceid = command.decode(response, 2)
+        self.address = bytes((deviceid.manufacturer_id,
+                              deviceid.device_type)) + deviceid.device_id
+        self._verified = True
+        if self.address_cache is not None:
+            self.address_cache.put(self.ser.port, self.tag, self.address,
+                                   deviceid.manufacturer_id,
+                                   deviceid.device_type)
+        return deviceid
+
+    def connect(self):
+        """ Identify a lazy device, if it is not yet.
+
+        Returns:
+            the device.
+        """
+        if self.address is None:
+            self.identify()
+        return self
+
+    @property
+    def connected(self):
+        """ True once the long address is known.
+        """
+        return self.address is not None
+
+    def close(self):
+        """ Release the serial port, closing it if no other device uses it.
+        """
+        if self._release is not None:
+            self._release()
+
+    @property
+    def long_address(self):
+        """ Long address (manufacturer, device type and device id) as
+        an hex string, identifying a lazy device (command #11 only, as
+        `comm2()`).
+        """
+        if self.address is None:
+            self.identify()
+        return self.address.hex()
 
     def pack(self, input_string):
         """ Turns a string in packed-ascii format.
@@ -58,17 +151,9 @@ class Brooks(object):
             8-characters string, i.e. `12345678`
 
         Returns:
-            The packed (6_bits) ASCII text.
+            The packed (6_bits) ASCII text, as an hex string.
         """
-        #This function lacks basic error checking....
-        klaf = ''
-        for s in input_string:
-            klaf += bin((ord(s) % 128) % 64)[2:].zfill(6)
-        result = ''
-        for i in range(0, 6):
-            result = result + hex(int('' + klaf[i * 8:i * 8 + 8],
-                                      2))[2:].zfill(2)
-        return result
+        return pack_ascii(input_string).hex()
 
     def crc(self, command):
         """ Calculate crc value of command.
@@ -81,17 +166,7 @@ class Brooks(object):
         Returns:
             the calculated crc.
         """
-        i = 0
-        while command[i:i + 2] == 'FF':
-            i += 2
-        command = command[i:]
-        n = len(command)
-        result = 0
-        for i in range(0, (n//2)):
-            byte_string = command[i*2:i*2+2]
-            byte = int(byte_string, 16)
-            result = byte ^ result
-        return hex(result)
+        return hex(checksum(bytes.fromhex(command).lstrip(b'\xff')))
 
     @staticmethod
     def get_bytes(n, data, nb=1):
@@ -116,54 +191,97 @@ class Brooks(object):
         """ Implements low-level details of the s-protocol.
 
         Args:
-            command: the command to send.
+            command: the command to send, from the delimiter up to the last
+            data byte (bytes or hex string).
 
         Returns:
-            2 bytes status code and data.
+            2 bytes status code and data (hex string), 'Error' on failure.
+        """
+        if isinstance(command, str):
+            command = bytes.fromhex(command)
+        try:
+            return self._transaction(encode_message(command)).data.hex()
+        except ErrorStatus:
+            return 'Error'
+
+    def _transaction(self, bytes_for_serial, attempts=None):
+        """ c.f. `transaction()`, on the port of this device, with
+        `self.attempts` attempts by default.
         """
-        check = str(self.crc(command))
-        check = check[2:].zfill(2)
-        final_com = 'FFFFFFFF' + command + check
-        bin_comm = ''
-        for i in range(0, len(final_com) // 2):
-            bin_comm += chr(int(final_com[i * 2:i * 2 + 2], 16))
-        bin_comm += chr(0)
-        bytes_for_serial = b(bin_comm)
-        error = 1
-        while (error > 0) and (error < 10):
-            self.ser.write(bytes_for_serial)
-            time.sleep(0.2)
-            s = self.ser.read(self.ser.inWaiting())
-            st = ''
-            for i in range(0, len(s)):
-                #char = hex(ord(s[i]))[2:].zfill(2)
-                #char = hex(s[i])[2:].zfill(2)
-                char = hex(indexbytes(s, i))[2:].zfill(2)
-                if not char.upper() == 'FF':
-                    st = st + char
-            try:
-                # delimiter = st[0:2]
-                # address = st[2:12]
-                command = st[12:14]
-                byte_count = int(st[14:16], 16)
-                response = st[16:16 + 2 * byte_count]
-                error = 0
-            except ValueError:
-                error = error + 1
-                response = 'Error'
-        return response
-
-    def comm2(self, cmd):
+        if attempts is None:
+            attempts = self.attempts
+        return transaction(self.ser, bytes_for_serial, self.timeout, attempts)
+
+    def comm2(self, cmd, data=b''):
         """ Same as `comm()` but splitted to: status, data.
 
         Args:
-            command: the command to send without delimiter character and long address.
+            cmd: the command number, or the legacy hex string holding the
+            command, byte count and data without delimiter character and
+            long address.
+            data: the request data (bytes) when `cmd` is a command number.
 
         Returns:
-            `status`, `data`.
+            `status`, `data` as memoryviews over the received bytes.
         """
-        response = self.comm('82' + self.long_address + cmd)
-        return response[:4], response[4:]
+        if isinstance(cmd, str):
+            raw = bytes.fromhex(cmd)
+            cmd, data = raw[0], raw[2:]
+        if self.address is None:
+            self.identify()
+        if not self._verified:
+            response = self._verify(cmd, data).data
+        else:
+            response = self._transaction(self._frame(cmd, data)).data
+        return response[:2], response[2:]
+
+    def _verify(self, cmd, data):
+        """ First transaction with an address read from the address cache.
+
+        The request is sent once; if the device does not answer at that
+        address, the cache entry is dropped, the device is identified again
+        with command #11 and the request is sent to the new address.
+
+        Returns:
+            the response `Frame`.
+        """
+        try:
+            frame = self._transaction(self._frame(cmd, data), attempts=1)
+        except ErrorStatus: # no reply from that address
+            if self.address_cache is not None:
+                self.address_cache.discard(self.ser.port, self.tag)
+            self.identify()
+            frame = self._transaction(self._frame(cmd, data))
+        self._verified = True
+        return frame
+
+    def _frame(self, cmd, data=b''):
+        """ Encoded request frame for this device.
+
+        Frames without data are constant and kept for the lifetime of the
+        instance; frames with data are kept in a bounded LRU cache.
+
+        Args:
+            cmd: the command number.
+            data: the request data (bytes).
+
+        Returns:
+            the frame (bytes), ready for `ser.write()`.
+        """
+        return self._frames.get(self.address, cmd, data)
+
+    def execute(self, command, *args):
+        """ Send a registered command and decode its response.
+
+        Args:
+            command: a `brooks_commands.Command`.
+            args: the request fields, in wire order.
+
+        Returns:
+            the command `Reply` namedtuple.
+        """
+        status, data = self.comm2(command.number, command.encode(*args))
+        return command.decode(data)
 
     def read_flow(self): #command #1
         """ c.f. *SLA document* page (36), section 6-2 Command #1 Read
@@ -181,17 +299,39 @@ class Brooks(object):
         Returns:
             `primary variable` (float).
          """
-
-        status, data = self.comm2('0100') # command = 01 byte count = 00
         try:  # TODO: This should be handled be re-sending command
-            unit_code = int(Brooks.get_bytes(0,data,1),16)
-            pv = Brooks.ieee_unpack(Brooks.get_bytes(1,data,4))[0]
-        except ValueError:
+            pv = self.execute(READ_PRIMARY_VARIABLE).pv
+        except (ErrorStatus, struct.error):
             pv = -1
             unit_code = 171  # Satisfy assertion check, we know what is wrong
         #assert unit_code == 171  # Flow unit should always be mL/min
         return pv
 
+    def read_dynamic_variables(self): #command #3
+        """ Universal command #3 Read Current and All Dynamic Variables.
+
+        Read the primary, secondary, tertiary and fourth variables with
+        their unit codes in a single transaction, instead of one command
+        per variable. The primary variable is the one of Command #1; the
+        assignment of the others depends on the device.
+
+        Returns:
+            the command #3 `Reply`: `current` (float, mA), `pv_unit_code`,
+            `pv`, `sv_unit_code`, `sv`, `tv_unit_code`, `tv`,
+            `qv_unit_code`, `qv`; the variables the device does not
+            return are None.
+
+        Raises:
+            ErrorStatus: no valid response.
+            struct.error: no primary variable in the response, i.e. the
+            device does not implement command #3.
+        """
+        status, data = self.comm2(READ_DYNAMIC_VARIABLES.number)
+        reply = READ_DYNAMIC_VARIABLES.decode_partial(data)
+        if reply.pv is None:
+            raise struct.error('no primary variable in command #3 response')
+        return reply
+
     def read_flow_range(self, select_code=1): #command #151 for SLA-series
         """ c.f. *SLA document* page (64), section 8-6 Command #151 Read
         Gas Density, Flow Reference and Flow Range.
@@ -210,19 +350,10 @@ class Brooks(object):
             `reference_flow_unit_code` (unsigned int).
         """
 
-        byte0 = hex(select_code)[2:].zfill(2)
-        status, data = self.comm2('97' + byte0 + '01') #Command 151, select_code 1, len 1
         try:  # TODO: This should be handled be re-sending command
-            gas_selection_code = int(Brooks.get_bytes(0,data,1),16)
-            density_unit_code = int(Brooks.get_bytes(1,data,1),16)
-            process_gas_density = Brooks.ieee_unpack(Brooks.get_bytes(2,data,4))[0]
-            reference_temperature_unit_code = int(Brooks.get_bytes(6,data,1),16)
-            reference_temperature_value = Brooks.ieee_unpack(Brooks.get_bytes(7,data,4))[0]
-            reference_pressure_unit_code = int(Brooks.get_bytes(11,data,1),16)
-            reference_pressure_value = Brooks.ieee_unpack(Brooks.get_bytes(12,data,4))[0]
-            unit_code = int(Brooks.get_bytes(16,data,1),16) #reference_flow_unit_code
-            flow_range = Brooks.ieee_unpack(Brooks.get_bytes(17,data,4))[0] #reference_flow_range_value
-        except ValueError:
+            reply = self.execute(READ_FLOW_RANGE, select_code)
+            flow_range, unit_code = reply.flow_range, reply.unit_code
+        except (ErrorStatus, struct.error):
             flow_range = -1
             unit_code = 171  # Satisfy assertion check, we know what is wrong
         #assert unit_code == 171  # Flow unit should always be mL/min
@@ -242,12 +373,8 @@ class Brooks(object):
             `selected_unit_code` (unsigned int).
 
         """
-        status, data = self.comm2('eb00') # command = eb byte count = 00
-        #percent_unit = int(Brooks.get_bytes(0,data,1),16) #always 57 (39 hex)
-        #setpoint_percent = Brooks.ieee_unpack(Brooks.get_bytes(1,data,4))[0]
-        select_unit = int(Brooks.get_bytes(5,data,1),16) # 250 (FA), etc.
-        setpoint = Brooks.ieee_unpack(Brooks.get_bytes(6,data,4))[0]
-        return setpoint, select_unit
+        reply = self.execute(READ_SETPOINT) # percent_unit_code is always 57 (39 hex)
+        return reply.setpoint, reply.unit_code
 
     def read_totalizer_status(self): #command 240
         """ c.f. *SLA document* page (89), section 8-33 Command #240 
@@ -263,10 +390,8 @@ class Brooks(object):
                 57(decimal percent) or 250(decimal, same unit as flowrate measurement)
 
         """
-        status, data = self.comm2('f000') # command = f0, byte count = 00
-        totaliser_status = int(Brooks.get_bytes(0,data,1),16)
-        totaliser_unit = int(Brooks.get_bytes(1,data,1),16)
-        return totaliser_status, totaliser_unit
+        reply = self.execute(READ_TOTALIZER_STATUS)
+        return reply.status, reply.unit_code
         
     def read_totalizer(self): #command 242
         """ c.f. *SLA document* page (90), section 8-35 Command #242 
@@ -282,11 +407,8 @@ class Brooks(object):
                 57(decimal percent) or 250(decimal, same unit as flowrate measurement)
 
         """
-        status, data = self.comm2('f200') # command = f2, byte count = 00
-        totaliser_unit = int(Brooks.get_bytes(0,data,1),16)
-        totaliser_count = Brooks.ieee_unpack(Brooks.get_bytes(1,data,4))[0]
-        
-        return totaliser_count, totaliser_unit
+        reply = self.execute(READ_TOTALIZER)
+        return reply.count, reply.unit_code
         
         #TODO def totalizers: commands 240-242 (p.89-92)
 
@@ -308,10 +430,7 @@ class Brooks(object):
             `totaliser_status`(unsigned int), see section 9-16 (p.102).
 
         """
-        byte0 = hex(cmd_code)[2:].zfill(2)
-        status, data = self.comm2('f101' + byte0)
-        totaliser_status = int(Brooks.get_bytes(0,data,1),16)
-        return totaliser_status
+        return self.execute(SET_TOTALIZER, cmd_code).status
 
     def set_flow(self, flowrate, unit_code=250): #command #236
         """ c.f.: *SLA document* page (87), section 8-31 Command #236 
@@ -343,15 +462,9 @@ class Brooks(object):
             `setpoint`(float) in %, 
             `selected_unit_code` (unsigned int), 
         """
-        ieee_flowrate = Brooks.ieee_pack(flowrate)
-        #ec05: ec = cmd 236; 05 = len(unit_code + ieee_sp)
         #39 (57 dec) = unit code for percent; FA (250 dec)= unit code for 'same unit as flowrate measurement'
-        status, data = self.comm2('ec05' + 'FA' + ieee_flowrate)
-        #percent_unit = int(Brooks.get_bytes(0,data,1),16) #always 57 (39 hex)
-        #setpoint_percent = Brooks.ieee_unpack(Brooks.get_bytes(1,data,4))[0]
-        select_unit = int(Brooks.get_bytes(5,data,1),16) # 17(l/min), 240(cc/min), etc.
-        setpoint = Brooks.ieee_unpack(Brooks.get_bytes(6,data,4))[0]
-        return setpoint, select_unit
+        reply = self.execute(WRITE_SETPOINT, unit_code, flowrate)
+        return reply.setpoint, reply.unit_code # 17(l/min), 240(cc/min), etc.
 
     def select_flow_unit(self, flow_unit, flow_ref=0): #command #196
         """ c.f. *SLA document* page (73), section 8-16 Command #196 
@@ -372,10 +485,8 @@ class Brooks(object):
         Returns:
             True if successful else False. 
         """
-        byte0 = hex(flow_ref)[2:].zfill(2)
-        byte1 = hex(flow_unit)[2:].zfill(2)
-        status, data = self.comm2('c402' + byte0 + byte1)
-        flag = byte0 == data[:2] and byte1 == data[2:]
+        reply = self.execute(SELECT_FLOW_UNIT, flow_ref, flow_unit)
+        flag = reply == (flow_ref, flow_unit)
         return flag
 
 if __name__ == "__main__":
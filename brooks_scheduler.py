@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_scheduler.py
+# Purpose:     multi-rate acquisition of the devices, independent of the GUI
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Headless acquisition, every variable of every device at its own rate.
+
+Each variable is read at its own period, i.e. the flow at 10 Hz, the
+setpoint at 1 Hz, the totalizer every 10 s and the flow range only when
+asked for. The reads of a port are spread over the period and run by one
+thread per port, on a monotonic time grid that does not drift. Every
+reading is published as a `Sample` to the subscribers::
+
+    scheduler = AcquisitionScheduler()
+    for mfc in mfcs:
+        scheduler.add(mfc, 'pv', 0.1)
+        scheduler.add(mfc, 'sp', 1.0)
+        scheduler.add(mfc, 'totalizer', 10.0)
+        scheduler.add(mfc, 'flow_range')        # on trigger() only
+    samples = queue.Queue()
+    scheduler.subscribe(samples.put)
+    scheduler.start()
+
+The callbacks run in the port threads and must return quickly.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+from collections import namedtuple, OrderedDict, deque
+
+from brooks_poller import port_of
+
+#: One reading: wall clock `time` and `monotonic` time of the read, index
+#: of the device in the scheduler, variable name, value (None on failure,
+#: the exception being in `error`).
+Sample = namedtuple('Sample', ['time', 'monotonic', 'device', 'variable',
+                               'value', 'error'])
+
+
+def read_pv(device):
+    return device.read_flow()
+
+
+def read_sp(device):
+    return device.read_setpoint()[0]
+
+
+def read_totalizer(device):
+    return device.read_totalizer()[0]
+
+
+def read_flow_range(device):
+    return device.read_flow_range()[0]
+
+
+def read_dynamic_variables(device):
+    return device.read_dynamic_variables()
+
+
+#: Read functions of the variables known by name.
+VARIABLES = {'pv': read_pv, 'sp': read_sp, 'totalizer': read_totalizer,
+             'flow_range': read_flow_range,
+             'dynamic_variables': read_dynamic_variables}
+
+
+class _Task(object):
+    """ One variable of one device, read every `period` seconds.
+    """
+    def __init__(self, index, device, variable, period, read):
+        self.index = index
+        self.device = device
+        self.variable = variable
+        self.period = period
+        self.read = read
+        self.due = None
+        self.samples = 0
+        self.errors = 0
+        self.overruns = 0
+        self.busy = 0.0
+
+
+class AcquisitionScheduler(object):
+    """ Reads device variables at fixed rates, one thread per port.
+
+    Args:
+        buses: optional `brooks_bus.BusManager`; the reads are then
+            submitted to the bus of each port, so that writes submitted
+            there with a higher priority go between them.
+    """
+    def __init__(self, buses=None):
+        self.buses = buses
+        self.devices = []
+        self._ports = OrderedDict()
+        self._tasks = {}
+        self._subscribers = []
+        self._triggered = {}
+        self._wake = {}
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, device, variable, period=None, read=None):
+        """ Read `variable` of `device` every `period` seconds.
+
+        Args:
+            device: i.e. a `Brooks` instance.
+            variable: name of the variable, one of `VARIABLES` unless
+                `read` is given.
+            period: seconds between two reads; None reads once at start
+                and then on `trigger()` only.
+            read: function called with the device, returning the value.
+
+        Returns:
+            the index of the device, as in the samples.
+        """
+        if self._threads:
+            raise RuntimeError('the scheduler is running')
+        if read is None:
+            read = VARIABLES[variable]
+        if device not in self.devices:
+            self.devices.append(device)
+        index = self.devices.index(device)
+        task = _Task(index, device, variable, period, read)
+        port = port_of(device)
+        if port not in self._ports:
+            self._ports[port] = []
+            self._triggered[port] = deque()
+            self._wake[port] = threading.Event()
+        self._ports[port].append(task)
+        self._tasks[(index, variable)] = task
+        return index
+
+    def subscribe(self, callback):
+        """ Call `callback(sample)` for every new `Sample`.
+        """
+        with self._lock:
+            self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers
+                                 if s != callback]
+
+    def trigger(self, device, variable):
+        """ Read `variable` of `device` as soon as its bus is free, i.e.
+        the flow range after a change of unit.
+        """
+        task = self._tasks[(self.devices.index(device), variable)]
+        port = port_of(device)
+        self._triggered[port].append(task)
+        self._wake[port].set()
+
+    def schedule(self):
+        """ Bus schedule of every port.
+
+        Returns:
+            `{port: [(offset, period, device index, variable), ...]}`, the
+            reads of each port with their offset in seconds from the
+            start, in time order.
+        """
+        schedule = OrderedDict()
+        for port, tasks in self._ports.items():
+            periodic = [task for task in tasks if task.period]
+            step = (min(task.period for task in periodic) / len(periodic)
+                    if periodic else 0.0)
+            entries = [(i * step, task.period, task.index, task.variable)
+                       for i, task in enumerate(periodic)]
+            entries += [(0.0, None, task.index, task.variable)
+                        for task in tasks if not task.period]
+            schedule[port] = sorted(entries, key=lambda e: e[0])
+        return schedule
+
+    def start(self):
+        """ Start one thread per port.
+        """
+        self._stop.clear()
+        start = time.monotonic()
+        offsets = dict(((index, variable), offset)
+                       for entries in self.schedule().values()
+                       for offset, _, index, variable in entries)
+        for port, tasks in self._ports.items():
+            for task in tasks:
+                task.due = start + offsets[(task.index, task.variable)]
+            thread = threading.Thread(target=self._run, args=(port, tasks),
+                                      daemon=True, name='acquisition %s'
+                                      % (port,))
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """ Stop the threads, after the reads in progress.
+        """
+        self._stop.set()
+        for wake in list(self._wake.values()):
+            wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        """ Counters of every read.
+
+        Returns:
+            `{(device index, variable): {'samples': int, 'errors': int,
+            'overruns': int, 'load': float}}`, `load` being the fraction
+            of the bus time the read uses at its period.
+        """
+        stats = {}
+        for key, task in self._tasks.items():
+            duration = task.busy / task.samples if task.samples else 0.0
+            stats[key] = {'samples': task.samples, 'errors': task.errors,
+                          'overruns': task.overruns,
+                          'load': duration / task.period if task.period
+                          else 0.0}
+        return stats
+
+    def _run(self, port, tasks):
+        order = itertools.count()
+        queue = [(task.due, next(order), task) for task in tasks]
+        heapq.heapify(queue)
+        triggered = self._triggered[port]
+        wake = self._wake[port]
+        while not self._stop.is_set():
+            if triggered:
+                self._read(port, triggered.popleft())
+                continue
+            if not queue:
+                wake.wait()
+                wake.clear()
+                continue
+            due, _, task = queue[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                wake.wait(wait)
+                wake.clear()
+                continue
+            heapq.heappop(queue)
+            self._read(port, task)
+            if task.period:
+                task.due += task.period
+                late = time.monotonic() - task.due
+                if late >= 0: # the slot is missed, keep on the grid
+                    missed = int(late // task.period) + 1
+                    task.due += missed * task.period
+                    task.overruns += missed
+                heapq.heappush(queue, (task.due, next(order), task))
+
+    def _read(self, port, task):
+        timestamp = time.time()
+        start = time.monotonic()
+        value = error = None
+        try:
+            if self.buses is not None:
+                value = self.buses.bus(port).call(task.read, task.device)
+            else:
+                value = task.read(task.device)
+        except Exception as e:
+            error = e
+            task.errors += 1
+        task.busy += time.monotonic() - start
+        task.samples += 1
+        sample = Sample(timestamp, start, task.index, task.variable, value,
+                        error)
+        for callback in self._subscribers:
+            callback(sample)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_transport.py
+# Purpose:     s-protocol transactions on a serial port
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Request/response exchange on a RS485 bus, shared by the drivers
+(`brooks_s_protocol`, `brooks_s_protocol_backend_serial`) and by the
+discovery.
+"""
+
+import time
+
+from brooks_frame import (parse_frame, is_reply_to, FrameDecoder, FrameError,
+                          ChecksumError)
+
+
+class ErrorStatus(Exception):
+    """ Example:
+    ```python
+    raise ErrorStatus('blabla...')
+    ```
+    """
+    pass
+
+
+def transaction(ser, bytes_for_serial, timeout=0.5, attempts=9):
+    """ Write an encoded frame and read back the response.
+
+    The input buffer is flushed before each write, and replies to an
+    other request (i.e. a reply to a previous transaction received after
+    its deadline) are skipped, so that a late reply is never taken for
+    the answer to the next request. A reply received with a wrong
+    checksum is re-requested at once, without waiting for the deadline.
+
+    Args:
+        ser: the `serial.Serial` of the bus.
+        bytes_for_serial: the frame built by `brooks_frame.encode_frame()`.
+        timeout: deadline in seconds of each attempt.
+        attempts: number of times the frame is sent at most.
+
+    Returns:
+        the response `Frame`, its data starting with the 2 status bytes.
+
+    Raises:
+        ErrorStatus: no valid response after `attempts` attempts.
+    """
+    request = parse_frame(bytes_for_serial)
+    for attempt in range(attempts):
+        ser.reset_input_buffer()
+        ser.write(bytes_for_serial)
+        try:
+            return receive(ser, timeout, request)
+        except FrameError as e:
+            error = e
+    raise ErrorStatus('no valid response: %s' % error)
+
+
+def receive(ser, timeout=0.5, request=None):
+    """ Read a response frame, using the byte count of its header to
+    know when it is complete. Partial frames are kept waiting for
+    until the deadline instead of triggering a re-send, and noise
+    before the reply is skipped by the `FrameDecoder`.
+
+    Everything already received is read at once. The read timeout of the
+    port is left alone when it is `timeout` already (c.f.
+    `brooks_ports.open_port()`), pyserial reconfiguring the port each time
+    it is set; a read then waits at most `timeout`, so a frame completed
+    just before the deadline may be waited for once more.
+
+    Args:
+        ser: the `serial.Serial` of the bus.
+        timeout: deadline in seconds.
+        request: the request `Frame`; frames which are not a reply to it
+            are skipped. Any frame is accepted when None.
+
+    Returns:
+        the response `Frame`.
+
+    Raises:
+        FrameError: the frame is not complete within `timeout` seconds.
+        ChecksumError: the reply was received with a wrong checksum.
+    """
+    if ser.timeout != timeout:
+        ser.timeout = timeout
+    deadline = time.monotonic() + timeout
+    decoder = FrameDecoder()
+    while True:
+        data = ser.read(max(decoder.needed, ser.in_waiting))
+        for frame in decoder.feed(data):
+            if request is None or is_reply_to(frame, request):
+                return frame
+        if decoder.checksum_errors:
+            raise ChecksumError('wrong checksum')
+        if time.monotonic() >= deadline:
+            raise FrameError('timeout, %d bytes pending'
+                             % len(decoder.buffer))
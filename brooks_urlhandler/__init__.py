@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        brooks_urlhandler
+# Purpose:     pyserial URL handlers of the driver
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" pyserial `serial_for_url()` handlers, registered by `brooks_ports`.
+
+- `brooks-sim://<name>?devices=<count>`: in-process simulated bus of
+  SLA58XX devices, c.f. `protocol_brooks-sim`.
+"""
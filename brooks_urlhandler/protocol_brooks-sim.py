@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        protocol_brooks-sim.py
+# Purpose:     pyserial URL handler of an in-process simulated Brooks bus
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" `brooks-sim://` ports: a multi-drop bus of `SimulatedDevice` in the
+calling thread.
+
+The devices answer every request during `write()`, so there is no pty
+and no thread, and the bytes still go through the whole driver::
+
+    mfc = Brooks('28478010', 'brooks-sim://rack1?devices=16')
+
+URL format: `brooks-sim://<name>[?option=value[&...]]`, options:
+
+- `devices`: number of devices (1), tags counted from `first_tag`.
+- `first_tag`: tag of the first device (28478010).
+- `tag`: explicit tag, may be repeated, replaces `devices`.
+- `flow_range`: full scale of the devices (10.0).
+
+The simulation time (i.e. of the totalizers) is the time the bytes
+written and read would take on the line at the port baud rate, so runs
+are deterministic. A read with nothing to receive waits for the timeout,
+like a real port.
+"""
+
+import time
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+from brooks_emulator import SimulatedBus, SimulatedDevice, rack
+
+
+class Serial(SerialBase):
+    """ Serial port connected to a `SimulatedBus`, available as `bus`.
+    """
+    def __init__(self, *args, **kwargs):
+        self.bus = None
+        #: Simulation time, in seconds.
+        self.elapsed = 0.0
+        self._input = bytearray()
+        super(Serial, self).__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException(
+                "Port must be configured before it can be used.")
+        self.bus = SimulatedBus(self.from_url(self.port))
+        self._reconfigure_port()
+        self.is_open = True
+        self.reset_input_buffer()
+
+    def close(self):
+        self.is_open = False
+        super(Serial, self).close()
+
+    def _reconfigure_port(self):
+        """ Settings are kept for the line timing only.
+        """
+        if not 0 < self._baudrate:
+            raise ValueError("invalid baudrate: {!r}".format(self._baudrate))
+
+    def from_url(self, url):
+        """ Devices described by the URL.
+
+        Returns:
+            list of `SimulatedDevice`.
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'brooks-sim':
+            raise SerialException(
+                'expected a string in the form "brooks-sim://<name>'
+                '[?devices=<count>]": not starting with brooks-sim:// '
+                '({!r})'.format(parts.scheme))
+        options = {'devices': ['1'], 'first_tag': ['28478010'],
+                   'flow_range': ['10.0']}
+        try:
+            for option, values in urlparse.parse_qs(parts.query, True).items():
+                if option not in options and option != 'tag':
+                    raise ValueError('unknown option: {!r}'.format(option))
+                options[option] = values
+            kwargs = {'flow_range': float(options['flow_range'][0]),
+                      'clock': lambda: self.elapsed}
+            if 'tag' in options:
+                return [SimulatedDevice(tag, i % 64, **kwargs)
+                        for i, tag in enumerate(options['tag'])]
+            return rack(int(options['devices'][0]),
+                        options['first_tag'][0], **kwargs)
+        except ValueError as e:
+            raise SerialException(
+                'expected a string in the form "brooks-sim://<name>'
+                '[?devices=<count>]": {}'.format(e))
+
+    def _line_time(self, count):
+        # start, 8 data, parity and stop bits per byte
+        return 11.0 * count / self._baudrate
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        return len(self._input)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+        if not self._input:
+            if self._timeout:
+                time.sleep(self._timeout)
+            return b''
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        self.elapsed += self._line_time(len(data))
+        return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+        data = bytes(data)
+        self.elapsed += self._line_time(len(data))
+        self._input += self.bus.feed(data)
+        return len(data)
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        del self._input[:]
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    def _update_break_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return True
+
+    @property
+    def dsr(self):
+        return True
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return True
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Name:        test_brooks.py
+# Purpose:     tests of the driver against a brooks-sim:// simulated bus
+#
+# Licence:     GPL-3.0
+#-------------------------------------------------------------------------------
+""" Run `python -m pytest -q` from the repository root; no hardware needed.
+"""
+
+import os
+import sys
+import time
+import struct
+import itertools
+import threading
+
+import pytest
+
+from brooks_frame import (encode_frame, parse_frame, pack_ascii, unpack_ascii,
+                          FrameDecoder, DELIMITER_LONG_REPLY)
+from brooks_commands import READ_PRIMARY_VARIABLE, READ_DYNAMIC_VARIABLES
+from brooks_address_cache import AddressCache
+from brooks_s_protocol import Brooks
+import brooks_s_protocol_backend_serial
+from brooks_bus import BusManager, PRIORITY_WRITE
+from brooks_poller import FleetPoller
+from brooks_ports import open_port, release_port, users
+from brooks_discovery import discover, scan
+from brooks_scheduler import AcquisitionScheduler
+from brooks_bulk import decode_capture, decode_payloads
+from brooks_faults import FaultySerial
+from brooks_history import RingBuffer
+from brooks_log import LogWriter, LogReader
+from brooks_emulator import PtyEmulator, rack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'ui_ihm'))
+from brooks_custom import BrooksCustom
+
+TAG = '28478010'
+ADDRESS = b'\x0a\x5a\x12\x34\x56'
+
+_buses = itertools.count()
+
+
+@pytest.fixture
+def port():
+    """ URL of a new simulated bus of 2 devices, tags 28478010 and 28478011.
+    """
+    return 'brooks-sim://test%d?devices=2' % next(_buses)
+
+
+class RecordingSerial(FaultySerial):
+    """ `FaultySerial` without faults, keeping the command numbers
+    written in `commands`.
+    """
+    def __init__(self, ser):
+        super(RecordingSerial, self).__init__(ser)
+        self.commands = []
+
+    def write(self, data):
+        self.commands.append(parse_frame(data).command)
+        return super(RecordingSerial, self).write(data)
+
+
+@pytest.fixture
+def custom(port):
+    """ Connected `BrooksCustom`, its commands recorded from now on.
+    """
+    mfc = BrooksCustom(TAG, port).connect()
+    mfc.ser = RecordingSerial(mfc.ser)
+    yield mfc
+    mfc.close()
+
+
+def test_round_trip(port):
+    mfc = Brooks(TAG, port)
+    try:
+        assert mfc.set_flow(5.0) == (5.0, 17)
+        assert mfc.read_flow() == 5.0
+        assert mfc.read_setpoint() == (5.0, 17)
+        assert mfc.read_flow_range() == (10.0, 17)
+    finally:
+        mfc.close()
+
+
+def test_devices_share_the_port(port):
+    first, second = Brooks(TAG, port), Brooks('28478011', port)
+    try:
+        assert first.ser is second.ser
+        assert first.address != second.address
+        first.set_flow(2.0)
+        assert (first.read_flow(), second.read_flow()) == (2.0, 0.0)
+    finally:
+        first.close()
+        second.close()
+
+
+def test_port_is_closed_by_its_last_user(port):
+    first, second = Brooks(TAG, port), Brooks('28478011', port)
+    ser = open_port(port)
+    assert ser is first.ser and users(port) == 3
+    release_port(port)
+    first.close()
+    assert users(port) == 1 and ser.is_open
+    assert second.read_flow() == 0.0
+    second.close()
+    assert users(port) == 0 and not ser.is_open
+    release_port(port)                       # already closed: no-op
+    assert open_port(port) is not ser
+    release_port(port)
+
+
+@pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pty')
+def test_pty_emulator_can_be_reopened():
+    with PtyEmulator(rack(1)) as emulator:
+        for flow in (1.0, 2.0, 3.0):
+            mfc = Brooks(TAG, emulator.port)      # odd parity, every time
+            try:
+                assert mfc.set_flow(flow) == (flow, 17)
+                assert mfc.read_flow() == flow
+            finally:
+                mfc.close()
+
+
+def test_bus_runs_writes_first(port):
+    manager = BusManager()
+    try:
+        bus = manager.bus(port)
+        mfc = brooks_s_protocol_backend_serial.Brooks(TAG, bus.ser)
+        busy, release, order = threading.Event(), threading.Event(), []
+        bus.submit(lambda: busy.set() or release.wait())
+        busy.wait()
+        reads = [bus.submit(lambda: order.append('read') or mfc.read_flow())
+                 for _ in range(3)]
+        write = bus.submit(lambda: order.append('write') or mfc.set_flow(6.0),
+                           priority=PRIORITY_WRITE)
+        assert manager.stats()[port]['queue_depth'] == 4
+        release.set()
+        assert write.result() == (6.0, 17)
+        assert [read.result() for read in reads] == [6.0] * 3
+        assert order == ['write', 'read', 'read', 'read']
+        assert manager.stats()[port]['queue_depth'] == 0
+        assert 0.0 < manager.stats()[port]['utilisation'] <= 1.0
+    finally:
+        manager.close()
+    assert bus.transactions == 5
+
+
+def test_poller_reads_the_ports_in_parallel(port):
+    other = 'brooks-sim://test%d?devices=2' % next(_buses)
+    mfcs = [Brooks(tag, bus) for bus in (port, other)
+            for tag in (TAG, '28478011')]
+
+    def slow_read(mfc):
+        time.sleep(0.1)
+        return mfc.read_flow()
+
+    poller = FleetPoller(mfcs, slow_read)
+    try:
+        assert list(poller.ports.values()) == [[0, 1], [2, 3]]
+        mfcs[3].set_flow(7.0)
+        snapshot = poller.poll()
+        assert snapshot.values == [0.0, 0.0, 0.0, 7.0]
+        assert snapshot.errors == {}
+        assert snapshot.duration < 0.35      # 2 reads per bus, not 4
+    finally:
+        poller.close()
+        for mfc in mfcs:
+            mfc.close()
+
+
+def test_discover(port):
+    found = discover([(TAG, port), ('28478011', port),
+                      (TAG, 'brooks-nosuch://port')], BrooksCustom)
+    try:
+        assert [mfc.tag for mfc in found.devices[:2]] == [TAG, '28478011']
+        assert found.devices[0].raw_data['fs'] == 10.0    # connected
+        assert found.devices[2] is None and list(found.errors) == [2]
+        assert all(seconds >= 0.0 for seconds in found.timings[:2])
+    finally:
+        for mfc in found.devices[:2]:
+            mfc.close()
+
+
+def test_scan(port, tmp_path):
+    cache = AddressCache(str(tmp_path / 'cache.json'))
+    found = scan([port], range(4), address_cache=cache)
+    try:
+        assert [mfc.tag for mfc in found.devices] == [TAG, '28478011']
+        assert found.errors == {}
+        assert (cache.get(port, TAG)['long_address']
+                == found.devices[0].address.hex())
+        assert found.devices[1].read_flow() == 0.0
+    finally:
+        for mfc in found.devices:
+            mfc.close()
+
+
+def test_scheduler_rates_and_trigger(port):
+    mfc = Brooks(TAG, port)
+    scheduler = AcquisitionScheduler()
+    scheduler.add(mfc, 'pv', 0.02)
+    scheduler.add(mfc, 'sp', 0.1)
+    scheduler.add(mfc, 'flow_range')
+    assert scheduler.schedule()[port] == [(0.0, 0.02, 0, 'pv'),
+                                          (0.0, None, 0, 'flow_range'),
+                                          (0.01, 0.1, 0, 'sp')]
+    samples, ranges = [], threading.Semaphore(0)
+
+    def collect(sample):
+        samples.append(sample)
+        if sample.variable == 'flow_range':
+            ranges.release()
+
+    scheduler.subscribe(collect)
+    scheduler.start()
+    try:
+        assert ranges.acquire(timeout=1.0)    # read once at start
+        time.sleep(0.5)
+        scheduler.trigger(mfc, 'flow_range')
+        assert ranges.acquire(timeout=1.0)
+    finally:
+        scheduler.stop()
+        mfc.close()
+    counts = dict((variable, sum(1 for sample in samples
+                                 if sample.variable == variable))
+                  for variable in ('pv', 'sp', 'flow_range'))
+    assert counts['flow_range'] == 2
+    assert 4 <= counts['sp'] <= 7
+    assert counts['pv'] >= 3 * counts['sp']
+    assert all(sample.error is None for sample in samples)
+    assert scheduler.stats()[(0, 'flow_range')]['samples'] == 2
+
+
+def test_late_reply_is_not_taken_for_the_next_one(port):
+    mfc = Brooks(TAG, port)
+    try:
+        mfc.set_flow(5.0)
+        mfc.ser = FaultySerial(mfc.ser, latency=0.1)
+        mfc.timeout, mfc.attempts = 0.05, 1
+        assert mfc.read_flow() == -1     # its reply is still on the line
+        mfc.ser.latency = 0.0
+        mfc.timeout, mfc.attempts = 0.5, 3
+        assert mfc.read_setpoint() == (5.0, 17)
+        assert mfc.read_totalizer() == (0.0, 250)
+        assert mfc.read_flow() == 5.0
+    finally:
+        mfc.close()
+
+
+def test_cached_address_is_verified(port, tmp_path):
+    cache = AddressCache(str(tmp_path / 'cache.json'))
+    actual = Brooks(TAG, port).address
+    cache.put(port, TAG, ADDRESS, ADDRESS[0], ADDRESS[1])   # wrong address
+    mfc = Brooks(TAG, port, address_cache=cache)
+    try:
+        assert mfc.address == ADDRESS
+        mfc.set_flow(3.0)          # no reply, identified again
+        assert mfc.address == actual
+        assert cache.get(port, TAG)['long_address'] == actual.hex()
+        assert mfc.read_flow() == 3.0
+    finally:
+        mfc.close()
+
+
+def test_long_address_reads_no_profile(port):
+    mfc = BrooksCustom(TAG, port, lazy=True)
+    try:
+        mfc.ser = FaultySerial(mfc.ser)
+        assert len(mfc.long_address) == 10
+        assert mfc.ser.writes == 1             # command #11 only
+        assert mfc.raw_data['fs'] is None
+    finally:
+        mfc.close()
+
+
+def test_steady_state_costs_one_transaction(custom):
+    for _ in range(3):
+        assert custom.get_all_data()['fs'] == 10.0
+    assert custom.ser.commands == [1, 1, 1]
+
+
+def test_set_flow_refreshes_the_cached_setpoint(custom):
+    assert custom.set_setpoint(4.0)
+    assert custom.get_all_data()['sp'] == 4.0
+    assert custom.ser.commands == [236, 1]
+
+
+def test_unit_change_reads_the_state_again(custom):
+    custom.set_unit('ml/min')
+    data = custom.get_all_data()
+    assert data['unit'] == 'ml/min'
+    assert custom.ser.commands == [196, 151, 235, 1]
+
+
+def test_expired_state_is_read_again(custom):
+    custom.state_ttl = 0.05
+    custom.get_all_data()
+    time.sleep(0.1)
+    custom.get_all_data()
+    assert custom.ser.commands == [1, 151, 235, 1]
+
+
+def test_packed_ascii_round_trip():
+    assert pack_ascii(TAG) == b'\xcb\x8d\x37\xe3\x0c\x70'
+    for text in (TAG, 'FLOW @ 5% [N2]', 'ABC'):
+        packed = pack_ascii(text)
+        assert len(packed) == (len(text) + 3) // 4 * 3
+        assert unpack_ascii(packed) == text.upper().ljust(len(packed) * 4 // 3)
+    assert unpack_ascii(bytearray(pack_ascii('tag'))) == 'TAG '
+
+
+def test_decoder_resynchronises():
+    good = encode_frame(ADDRESS, 1, b'\x00\x00' + struct.pack('>Bf', 17, 1.5),
+                        DELIMITER_LONG_REPLY)
+    bad = bytearray(good)
+    bad[-2] ^= 0xff                          # wrong checksum
+    for noise, checksum_errors in [(b'\x12\xff\xff\x86\x0a', None), # cut short
+                                   (bytes(bad) + b'\x00\x55', 1)]:
+        decoder = FrameDecoder()
+        frames = []
+        data = noise + good
+        for i in range(0, len(data), 3):
+            frames += decoder.feed(data[i:i + 3])
+        assert len(frames) == 1
+        assert READ_PRIMARY_VARIABLE.decode(frames[0].data, 2).pv == 1.5
+        if checksum_errors is not None:
+            assert decoder.checksum_errors == checksum_errors
+
+
+def test_decoder_needed_after_noise():
+    frame = encode_frame(ADDRESS, 1, b'\x00\x00' + struct.pack('>Bf', 17, 1.5),
+                         DELIMITER_LONG_REPLY)[:-1]     # no pad byte
+    decoder = FrameDecoder()
+    assert decoder.feed(b'\x01\x02\x03' + frame[:12]) == []
+    assert decoder.needed == len(frame) - 12
+    assert len(decoder.feed(frame[12:])) == 1
+
+
+def test_decode_partial():
+    full = struct.pack('>fBfBfBfBf', 12.0, 17, 5.0, 32, 20.0, 17, 5.0, 250,
+                       1.0)
+    assert READ_DYNAMIC_VARIABLES.decode_partial(full).qv == 1.0
+    reply = READ_DYNAMIC_VARIABLES.decode_partial(full[:9])
+    assert (reply.current, reply.pv_unit_code, reply.pv) == (12.0, 17, 5.0)
+    assert reply.sv_unit_code is None and reply.qv is None
+    with pytest.raises(struct.error):
+        READ_DYNAMIC_VARIABLES.decode_partial(b'')
+
+
+def test_decode_capture():
+    replies = [encode_frame(ADDRESS, 1,
+                            b'\x00\x00' + struct.pack('>Bf', 17, pv),
+                            DELIMITER_LONG_REPLY) for pv in (1.5, 2.5)]
+    error = encode_frame(ADDRESS, 1, b'\x40\x00', DELIMITER_LONG_REPLY)
+    values = decode_capture(b'\x12' + replies[0] + error + replies[1])
+    records = values[ADDRESS.hex()][READ_PRIMARY_VARIABLE.name]
+    assert list(records['pv']) == [1.5, 2.5]
+    assert list(records['unit_code']) == [17, 17]
+    payloads = [struct.pack('>Bf', 17, 3.0), struct.pack('>Bf', 57, 4.0)]
+    assert list(decode_payloads(READ_PRIMARY_VARIABLE, payloads)['pv']) \
+        == [3.0, 4.0]
+    with pytest.raises(ValueError):
+        decode_payloads(READ_PRIMARY_VARIABLE, [b'\x11'])
+
+
+def test_read_dynamic_variables(port):
+    mfc = Brooks(TAG, port)
+    try:
+        mfc.set_flow(4.0)
+        reply = mfc.read_dynamic_variables()
+        assert (reply.pv, reply.tv) == (4.0, 4.0)
+    finally:
+        mfc.close()
+
+
+def test_ring_buffer_wraps_around():
+    history = RingBuffer(4)
+    for i in range(10):
+        history.append(float(i), 0, i, i)
+    assert len(history) == 4
+    assert list(history.last()['time']) == [6.0, 7.0, 8.0, 9.0]
+    assert list(history.last(2)['pv']) == [8.0, 9.0]
+    assert not history.last().flags.writeable
+
+
+def test_log_reader_bisection(tmp_path):
+    start = time.monotonic_ns()
+    with LogWriter(str(tmp_path), chunk_records=400) as log:
+        for i in range(1000):                    # 10 Hz, 100 s
+            log.append(3, float(i), 1.0, 0, start + i * 10**8)
+    reader = LogReader(str(tmp_path))
+    assert reader.devices() == [3]
+    assert [len(chunk) for chunk in reader.chunks(3)] == [400, 400, 200]
+    origin = reader.chunks(3)[0].wall_time()[0]
+    views = reader.read(3, origin + 34.95, origin + 44.95)
+    pv = [value for view in views for value in view['pv']]
+    assert pv == [float(i) for i in range(350, 450)]
+    assert sum(len(view) for view in reader.read(3)) == 1000
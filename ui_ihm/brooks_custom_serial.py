@@ -1,6 +1,7 @@
-import sys
+import sys, time, struct
 sys.path.append('..')
-from brooks_s_protocol_backend_serial import Brooks
+from brooks_s_protocol_backend_serial import Brooks, ErrorStatus
+from brooks_commands import READ_FLOW_RANGE, READ_SETPOINT
 
 import numpy as np
 
@@ -17,36 +18,129 @@ def unit_code_to_string(unit_code_or_str, reverse=False):
 
 class BrooksCustom(Brooks):
     numInstances = 0
+    #: Seconds after which the cached flow range and setpoint are read
+    #: again; None keeps them until the MFC is written to.
+    state_ttl = None
+    #: If True, the flow is read with command #3, which also returns the
+    #: other dynamic variables (kept in `dynamic_variables`), instead of
+    #: command #1. Falls back to command #1 if the MFC does not know it.
+    use_dynamic_variables = False
 
-    def __init__(self, tag, uartdriver):
+    def __init__(self, tag, uartdriver, address_cache=None, long_address=None,
+                 lazy=False):
         """
 
         Args:
             tag: 8 digits tag number of MFC
             port: comport
+            address_cache: optional `AddressCache` skipping command #11
+            long_address: optional known long address, skipping it too
+            lazy: no bus I/O until the first use or `connect()`
         """
-        super(BrooksCustom, self).__init__(tag, uartdriver)
+        super(BrooksCustom, self).__init__(tag, uartdriver, address_cache,
+                                          long_address, lazy)
         self.count()
         self.data_desc = ['unit', 'fs', 'sp', 'pv']
         self.raw_data = {}
         for desc in self.data_desc:
             self.raw_data[desc] = None
+        self.state = {} # (time.monotonic(), reply) of the cached commands
+        self.dynamic_variables = None
 
     @classmethod
     def count(cls):
         cls.numInstances += 1
 
+    def connect(self):
+        """ Identify the MFC and read its profile (unit, fs, sp, pv) into
+        `raw_data`, if not done yet. """
+        super(BrooksCustom, self).connect()
+        if self.raw_data[self.data_desc[1]] is None:
+            self.get_all_data()
+        return self
+
+    def _cached(self, key):
+        entry = self.state.get(key)
+        if entry is None:
+            return None
+        if (self.state_ttl is not None and
+                time.monotonic() - entry[0] > self.state_ttl):
+            return None
+        return entry[1]
+
+    def _store(self, key, reply):
+        self.state[key] = (time.monotonic(), reply)
+
+    def invalidate(self):
+        """ Forget the cached flow range and setpoint. """
+        self.state.clear()
+
+    def read_gas_data(self, select_code=1):
+        """ Command #151 reply: flow range and unit, density and reference
+        conditions of the gas, cached.
+
+        Raises:
+            ErrorStatus: no valid response.
+        """
+        reply = self._cached((READ_FLOW_RANGE, select_code))
+        if reply is None:
+            reply = self.execute(READ_FLOW_RANGE, select_code)
+            self._store((READ_FLOW_RANGE, select_code), reply)
+        return reply
+
+    def read_flow_range(self, select_code=1):
+        """ Cached `Brooks.read_flow_range()`. """
+        try:
+            reply = self.read_gas_data(select_code)
+        except (ErrorStatus, struct.error):
+            return -1, 171
+        return reply.flow_range, reply.unit_code
+
+    def read_setpoint(self):
+        """ Cached `Brooks.read_setpoint()`. """
+        setpoint = self._cached(READ_SETPOINT)
+        if setpoint is None:
+            setpoint = super(BrooksCustom, self).read_setpoint()
+            self._store(READ_SETPOINT, setpoint)
+        return setpoint
+
+    def set_flow(self, flowrate, unit_code=250):
+        """ `Brooks.set_flow()`, caching the setpoint echoed by the MFC. """
+        self.state.pop(READ_SETPOINT, None)
+        setpoint = super(BrooksCustom, self).set_flow(flowrate, unit_code)
+        self._store(READ_SETPOINT, setpoint)
+        return setpoint
+
+    def select_flow_unit(self, flow_unit, flow_ref=0):
+        """ `Brooks.select_flow_unit()`, the flow range and setpoint are
+        read again in the new unit. """
+        self.invalidate()
+        return super(BrooksCustom, self).select_flow_unit(flow_unit, flow_ref)
+
     def get_all_data(self):
-        """ (fs, unit) + (sp, unit) + pv """
+        """ (fs, unit) + (sp, unit) + pv
+
+        fs, unit and sp come from the cache once read: 1 transaction. """
 
         self.raw_data[self.data_desc[1]], ref_unit_code = self.read_flow_range()
         self.raw_data[self.data_desc[2]], unit_code = self.read_setpoint()
         self.raw_data[self.data_desc[0]] = unit_code_to_string(unit_code)
-        self.raw_data[self.data_desc[3]] = self.read_flow()
+        self.get_pv()
         return self.raw_data
     
     def get_pv(self):
-        self.raw_data[self.data_desc[3]] = self.read_flow()
+        if self.use_dynamic_variables:
+            try:
+                self.dynamic_variables = self.read_dynamic_variables()
+                pv = self.dynamic_variables.pv
+            except ErrorStatus:
+                pv = -1
+            except struct.error: # command #3 not implemented
+                self.use_dynamic_variables = False
+                pv = self.read_flow()
+        else:
+            pv = self.read_flow()
+        self.raw_data[self.data_desc[3]] = pv
         return self.raw_data[self.data_desc[3]]
 
     def set_unit(self, unit_str, flow_ref=0):
@@ -9,17 +9,21 @@ import sys, time
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QMenu, QAction
 from PyQt5.QtCore import Qt
 
+import numpy as np
 import pyqtgraph as pg
 
 import ui_brooks_simple as ihm
 import qdarkstyle
 
-import serial
 from serial.tools.list_ports import comports
-import numpy as np
 
 from brooks_custom_serial import BrooksCustom as BrooksMFC
 from doomy import Doomy as DoomyMFC
+from brooks_poller import FleetPoller
+from brooks_discovery import discover
+from brooks_address_cache import AddressCache
+from brooks_history import RingBuffer, FLAG_ERROR
+from brooks_log import LogWriter
 
 import re
 
@@ -29,9 +33,11 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
     """
     Dessine l'interface graphique
     """    
-    def __init__(self, nb_mfcs=1, simulation_mode=True):
+    def __init__(self, nb_mfcs=1, simulation_mode=True, dynamic_variables=False,
+                 log_directory=None):
         super(MainWindow, self).__init__()
         self.simulation_mode = simulation_mode
+        self.dynamic_variables = dynamic_variables # pv lu par la commande #3
         self.period_timer = 500 #ms
         self.mon_timer = None
         assert nb_mfcs <= MAX_INSTANCE_NUMBER
@@ -60,8 +66,14 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
         self.list_units = [None]*MAX_INSTANCE_NUMBER
 
         self.mfcs = [None]*MAX_INSTANCE_NUMBER #hardware MFCs or simulation
-        self.ports_used = {}
+        self.poller = None #reads MFCs of different ports in parallel
+        self.address_cache = AddressCache() #skips command #11 for known MFCs
         self.plt_zt = []
+        self.history = [] #RingBuffer des échantillons de chaque MFC
+        self.history_length = 7200 #échantillons, 1 h à 500 ms
+        self.log = None #LogWriter: échantillons enregistrés sur disque
+        if log_directory is not None:
+            self.log = LogWriter(log_directory)
 
         # connexion des actions:
         self.actionConnect.triggered.connect(self.connectMFCs)
@@ -94,8 +106,6 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
         # fill comboBoxes with available ports
         for port in available_ports:
             l=[]
-            if port.device not in self.ports_used.keys():
-                self.ports_used[port.device] = None, None
             for i in range(MAX_INSTANCE_NUMBER):
                 for count in range(self.list_comport_widgets[i].count()):
                     l.append(self.list_comport_widgets[i].itemText(count))
@@ -110,33 +120,28 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
         self.isConnected = False
         self.pb_start.setEnabled(False)
         self.stop_data_streaming()
+        for mfc in self.mfcs:
+            if hasattr(mfc, 'close'): # previous hw mode, release the ports
+                mfc.close()
+        self.mfcs = [None]*MAX_INSTANCE_NUMBER
         for i in range(self.nb_mfcs):
             if self.simulation_mode:
-                #TODO: if previous hw mode, close all ports
                 self.mfcs[i] = DoomyMFC()
                 self.isConnected = True
             else: # device mode
                 self.list_tags[i] = self.list_tag_widgets[i].text() #copie les tags des widgets dans une liste
                 self.list_comports[i] = self.list_comport_widgets[i].currentText() #copie les noms des ports dans une liste
-                if not self.ports_used[self.list_comports[i]][0]: #if not opened, open port once and connect to first mfc
-                    try:
-                        self.uartdriver = serial.Serial(self.list_comports[i], 19200) # be sure that this port is not used in another app!
-                        self.uartdriver.parity = serial.PARITY_ODD
-                        self.uartdriver.bytesize = serial.EIGHTBITS
-                        self.uartdriver.stopbits = serial.STOPBITS_ONE
-                        self.mfcs[i] = BrooksMFC(self.list_tags[i], self.uartdriver) #first connect to Brooks
-                        self.ports_used[self.list_comports[i]] = True, [self.list_tags[i]] #(isOpen, [connected tag])
-                        self.isConnected = True
-                        print("first open port done")
-                    except IOError: #port is used in another app!
-                        self.isConnected = False
-                else: # port already opened, connect to many mfcs
-                    if self.list_tags[i] not in self.ports_used[self.list_comports[i]][1]: # check this tag is not yet used
-                        if self.isConnected:
-                            self.mfcs[i] = BrooksMFC(self.list_tags[i], self.uartdriver) #add one more mfc to the same port
-                            self.ports_used[self.list_comports[i]] = True, self.ports_used[self.list_comports[i]][1].append(self.list_tags[i]) #update status
-                    print("add more Brooks done")
-                print(self.ports_used)
+        if not self.simulation_mode:
+            # identification et lecture du profil en parallèle sur les
+            # différents ports (connect_all)
+            found = discover(zip(self.list_tags[:self.nb_mfcs],
+                                 self.list_comports[:self.nb_mfcs]),
+                             BrooksMFC, self.address_cache)
+            self.mfcs[:self.nb_mfcs] = found.devices
+            for mfc in found.devices:
+                if mfc is not None:
+                    mfc.use_dynamic_variables = self.dynamic_variables
+            self.isConnected = not found.errors #port is used in another app!
 
         self.pb_start.setEnabled(self.isConnected)
         self.on_init()
@@ -146,6 +151,11 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
         personnalisation de l'interface
         """        
         if self.isConnected:
+            if self.poller is not None:
+                self.poller.close()
+            self.poller = FleetPoller(self.mfcs[:self.nb_mfcs],
+                                      read=lambda mfc: mfc.get_all_data())
+
             # une méthode pour initialiser  le buffer de données
             self.init_raw_data()
 
@@ -165,36 +175,32 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
 
     def init_raw_data(self, nb=300):
         """
-        brooks data
+        brooks data, les nb derniers pv sont tracés
         """
-        self.RAW_DATA = {'time': None}
+        self.plot_length = nb
+        self.RAW_DATA = {}
         self.current_names=[None]*MAX_INSTANCE_NUMBER
         for i in range(self.nb_mfcs):
             for name in self.data_desc:
                 self.current_names[i] = self.list_gase_widgets[i].text()
                 self.RAW_DATA[name+'_'+self.current_names[i]] = None
 
-        self.RAW_DATA['time'] = [time.time()]
-        
+        t = time.time()
+        self.history = [RingBuffer(self.history_length) for i in range(self.nb_mfcs)]
         for i in range(self.nb_mfcs):
-            DATA = self.mfcs[i].get_all_data() # {'unit': str, 'fs': float, 'sp': float, 'pv': float}
-            self.__unit_changed(i,DATA[self.data_desc[0]])
+            DATA = self.mfcs[i].raw_data # lu par connect_all(): {'unit': str, 'fs': float, 'sp': float, 'pv': float}
+            self.__show_unit(i,DATA[self.data_desc[0]]) # déjà l'unité du MFC
             self.list_fullscale_widgets[i].setText('FS = ' + '%.2f' % DATA[self.data_desc[1]])
             self.list_fs[i] = DATA[self.data_desc[1]]
             self.list_sp_widgets[i].setMaximum(self.list_fs[i])
             self.list_sp_widgets[i].setValue(DATA[self.data_desc[2]])
             self.list_pv_widgets[i].setText('%.2f' % DATA[self.data_desc[-1]])
 
-            for name in self.data_desc[:-1]:
+            for name in self.data_desc:
                 self.RAW_DATA[name+'_'+self.current_names[i]] = DATA[name]
-            self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]] = [DATA[self.data_desc[-1]]]
+            # première mesure; la courbe est complétée par des zéros à l'affichage
+            self.history[i].append(t, i, DATA[self.data_desc[-1]], DATA[self.data_desc[2]])
         print(i, DATA)
-        while nb > 1:
-            self.RAW_DATA['time'].append(time.time())
-            for i in range(self.nb_mfcs):
-                #DATA = self.mfcs[i].get_pv() # {'unit': str, 'fs': float, 'sp': float, 'pv': float}
-                self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]].append(0.0)            
-            nb -= 1
 
     def connexion_and_init_plot(self):
         # création des zones de tracer
@@ -207,16 +213,26 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
                 # création d'un plot dans chaque zone de tracé
                 print(i, "other plt_zt")
                 self.plt_zt.append(self.graphicsWindow.getItem(i,0).plot(
-                    self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]],
-                    pen=self.pencolors[i %3])) # data_desc[-1] = plot 'pv'
+                    self.__plot_pv(i),
+                    pen=self.pencolors[i %3])) # plot 'pv'
         print(i, len(self.plt_zt))
                 #self.graphicsWindow.getItem(i,0).setTitle("other1_"+self.current_names[i])
+
+    def __plot_pv(self, i):
+        """
+        les plot_length derniers pv du MFC i, précédés de zéros tant que
+        l'historique est plus court (le RingBuffer ne garde que les mesures)
+        """
+        pv = self.history[i].last(self.plot_length)['pv']
+        return np.concatenate((np.zeros(self.plot_length - len(pv), pv.dtype), pv))
                 
     # connexion des unités
     def __unit_changed(self, idx, unit):
+        self.__show_unit(idx, unit)
+        self.mfcs[idx].set_unit(unit)
+    def __show_unit(self, idx, unit):
         self.list_unit_widgets[idx].setText(unit)
         self.list_sp_widgets[idx].setSuffix(' ' + unit)
-        self.mfcs[idx].set_unit(unit)
     def on_unit_1_customContextMenuRequested(self, position):
         selectedItem = self.custommenu.exec_(self.unit_1.mapToGlobal(position))    
         if selectedItem:
@@ -377,23 +393,30 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
         if self.mon_timer is not None:
             self.killTimer(self.mon_timer)
             self.mon_timer = None
+        if self.log is not None:
+            self.log.flush()
 
     def timerEvent(self, _):        
-        t = time.time()
+        t_ns = time.monotonic_ns() # horodatage du log
+        snapshot = self.poller.poll() # all MFCs, ports polled in parallel
+        t = snapshot.timestamp
         
-        self.RAW_DATA['time'] = np.roll(self.RAW_DATA['time'], -1)
-        self.RAW_DATA['time'][-1] = t
-        #DATA = self.mfcs.get_all_data()
-        
-        #roll RAW_DATA:
+        # ajout O(1) dans les RingBuffer, pas de np.roll
         for i in range(self.nb_mfcs):
-            DATA = self.mfcs[i].get_all_data() # {'unit': str, 'fs': float, 'sp': float, 'pv': float}
-            self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]] = np.roll(self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]],-1)
-            self.RAW_DATA[self.data_desc[-1]+'_'+self.current_names[i]][-1] = DATA[self.data_desc[-1]]
-
-            self.list_pv_widgets[i].setText('%.2f' % DATA[self.data_desc[-1]])
-            self.plt_zt[i].setData(self.RAW_DATA[self.data_desc[-1]+
-                '_'+self.current_names[i]])
+            DATA = snapshot.values[i] # {'unit': str, 'fs': float, 'sp': float, 'pv': float}
+            history = self.history[i]
+            if DATA is None: # read failed, see snapshot.errors[i]
+                last = history.last(1)[0]
+                history.append(t, i, last['pv'], last['sp'], FLAG_ERROR)
+                if self.log is not None:
+                    self.log.append(i, last['pv'], last['sp'], FLAG_ERROR, t_ns)
+                continue
+            history.append(t, i, DATA['pv'], DATA['sp'])
+            if self.log is not None:
+                self.log.append(i, DATA['pv'], DATA['sp'], 0, t_ns)
+
+            self.list_pv_widgets[i].setText('%.2f' % DATA['pv'])
+            self.plt_zt[i].setData(self.__plot_pv(i))
 
     def closeEvent(self, event):
         """
@@ -407,6 +430,8 @@ class MainWindow(QMainWindow, ihm.Ui_MainWindow):
                                                  QMessageBox.No))
         if result == QMessageBox.Yes:
             # permet d'ajouter du code pour fermer proprement
+            if self.log is not None:
+                self.log.close()
             event.accept()
         else:
             event.ignore()